@@ -0,0 +1,144 @@
+""" Caching of expensive function results, in process and on disk with joblib.
+
+    Settings come from these environment variables and can be changed with configure():
+      PYTHON_UTILS_CACHE_DIR        Disk cache location, default ~/.cache/python_utils
+      PYTHON_UTILS_CACHE            Set to 0 to disable caching
+      PYTHON_UTILS_CACHE_BYTES      Maximum size of the disk cache, least recently used entries are evicted
+      PYTHON_UTILS_CACHE_ITEMS      Number of results kept in the in-process cache, default 32
+"""
+
+import copy
+import functools
+import inspect
+import os
+import sys
+import time
+
+from collections import OrderedDict
+
+import joblib
+
+import numpy as np
+
+def _env_int(name, default=None):
+  val = os.environ.get(name)
+  return default if val is None or val == '' else int(val)
+
+config = dict(
+  location=os.environ.get('PYTHON_UTILS_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'python_utils'),
+  enabled=os.environ.get('PYTHON_UTILS_CACHE', '1') != '0',
+  bytes_limit=_env_int('PYTHON_UTILS_CACHE_BYTES'),
+  memory_items=_env_int('PYTHON_UTILS_CACHE_ITEMS', 32),
+  # Minimum number of seconds between disk cache size checks
+  reduce_interval=10.0,
+)
+
+_memory = None
+_last_reduce = 0.0
+memory_cache = OrderedDict()
+
+def configure(**kwargs):
+  """ Updates config, e.g. configure(location='/scratch/cache', bytes_limit=10 * 2 ** 30) """
+  global _memory
+  for key, val in kwargs.items():
+    assert key in config, "Unknown cache setting %s" % key
+    config[key] = val
+
+  _memory = None
+  clear_memory_cache()
+
+def get_memory():
+  """ The joblib Memory for the configured location, created on first use """
+  global _memory
+  if _memory is None:
+    _memory = joblib.Memory(config['location'], verbose=0)
+  return _memory
+
+def clear_memory_cache():
+  memory_cache.clear()
+
+def reduce_size(force=False):
+  """ Evicts the least recently used disk cache entries beyond bytes_limit """
+  global _last_reduce
+  if config['bytes_limit'] is None:
+    return
+
+  now = time.time()
+  if force or now - _last_reduce > config['reduce_interval']:
+    get_memory().reduce_size(bytes_limit=config['bytes_limit'])
+    _last_reduce = now
+
+def fingerprint(arr, n_samples=1024):
+  """ Cheap stand-in for hashing an entire array:
+      its shape, dtype and a hash of about n_samples evenly spaced elements.
+  """
+  arr = np.asarray(arr)
+  step = max(1, arr.size // n_samples)
+  return arr.shape, arr.dtype.str, joblib.hash(arr.flat[::step]), joblib.hash(arr.flat[-1:])
+
+def cached(func):
+  """
+    Caches func in memory and on disk and adds two keyword arguments to it:
+      cache=False calls func directly, bypassing the cache.
+      cheap_key=True keys array arguments by their fingerprint instead of hashing their contents.
+        This is much faster for large inputs, but can return a stale result
+        for inputs that differ only in elements that are not sampled.
+    Results from the in-process cache are copies, so callers can modify them.
+    Results are keyed on the source of func's whole module, so editing any of it invalidates them.
+  """
+  signature = inspect.signature(func)
+  disk = dict(memory=None, func=None)
+
+  # The source is part of the key, since joblib only checks the code of keyed.
+  # It is that of the whole module, so that changes to helpers func calls also invalidate results.
+  try:
+    source = inspect.getsource(sys.modules[func.__module__])
+  except (KeyError, OSError, TypeError):
+    try:
+      source = inspect.getsource(func)
+    except (OSError, TypeError):
+      source = func.__code__.co_code
+  source = joblib.hash(source)
+
+  def keyed(key, args, kwargs):
+    return func(*args, **kwargs)
+
+  keyed.__name__ = keyed.__qualname__ = func.__qualname__
+  keyed.__module__ = func.__module__
+
+  def to_key(arg):
+    return fingerprint(arg) if isinstance(arg, np.ndarray) else arg
+
+  @functools.wraps(func)
+  def wrapper(*args, cache=True, cheap_key=False, **kwargs):
+    if not (cache and config['enabled']):
+      return func(*args, **kwargs)
+
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = bound.arguments
+    if cheap_key:
+      arguments = {name: to_key(arg) for name, arg in arguments.items()}
+
+    key = joblib.hash((func.__module__, func.__qualname__, source, arguments))
+
+    if key in memory_cache:
+      memory_cache.move_to_end(key)
+      return copy.deepcopy(memory_cache[key])
+
+    memory = get_memory()
+    if disk['memory'] is not memory:
+      disk['memory'] = memory
+      disk['func'] = memory.cache(keyed, ignore=['args', 'kwargs'])
+
+    result = disk['func'](key, args, kwargs)
+    reduce_size()
+
+    if config['memory_items'] > 0:
+      memory_cache[key] = copy.deepcopy(result)
+      while len(memory_cache) > config['memory_items']:
+        memory_cache.popitem(last=False)
+
+    return result
+
+  return wrapper
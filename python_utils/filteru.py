@@ -1,14 +1,9 @@
-import os
-
-import joblib
-
 import numpy as np
 
 from scipy.interpolate import interp1d
-from scipy.signal import lfilter
+from scipy.signal import lfilter, lfiltic
 
-cachedir = os.path.join(os.path.expanduser('~'), '.cache', 'python_utils')
-memory = joblib.Memory(cachedir, verbose=0)
+from python_utils.cacheu import cached
 
 class DF1:
   def __init__(self, b, a, initial_value=0):
@@ -32,18 +27,121 @@ class DF1:
 
     return yn
 
-@memory.cache
-def exp_smooth(vals, alpha):
-  """ y_{t+1} = (1 - alpha) y_t + alpha x_t
-      TODO Use a scipy method? """
-  smooth = np.array(vals[0], dtype=float)
-  smoothed = [smooth.copy()]
+class BiquadBank:
+  """ K independent DF1 biquads, filtering a K-vector per call.
+      b and a are (K, 3); assigning to them (or calling set_coefficients)
+      updates the coefficients in place and keeps the filter state.
+  """
+  def __init__(self, b, a, initial_value=0):
+    b = np.array(b, dtype=float)
+    a = np.array(a, dtype=float)
+    assert b.ndim == 2 and b.shape == a.shape and b.shape[1] == 3
+
+    K = len(b)
+    # Rows are (b0, b1, b2, -a1, -a2) . (x_n, x_{n-1}, x_{n-2}, y_{n-1}, y_{n-2})
+    self.coeffs = np.empty((K, 5))
+    self.hist = np.empty((K, 5))
+    self.hist[:] = initial_value
+    self.set_coefficients(b, a)
+
+  def __len__(self):
+    return len(self.coeffs)
+
+  @property
+  def b(self):
+    return self.coeffs[:, :3].copy()
+
+  @b.setter
+  def b(self, b):
+    self.coeffs[:, :3] = b
+
+  @property
+  def a(self):
+    a = np.ones((len(self), 3))
+    a[:, 1:] = -self.coeffs[:, 3:]
+    return a
+
+  @a.setter
+  def a(self, a):
+    a = np.broadcast_to(a, (len(self), 3))
+    assert np.all(a[:, 0] == 1)
+    self.coeffs[:, 3:] = -a[:, 1:]
+
+  def set_coefficients(self, b, a, inds=slice(None)):
+    """ Updates the coefficients of the filters at inds """
+    a = np.asarray(a, dtype=float)
+    assert np.all(a[..., 0] == 1)
+    self.coeffs[inds, :3] = b
+    self.coeffs[inds, 3:] = -a[..., 1:]
+
+  def filter(self, vals):
+    h = self.hist
+    h[:, 0] = vals
+    yn = np.einsum('ij,ij->i', self.coeffs, h)
+
+    # Shift (x_{n-1}, y_{n-1}) to (x_{n-2}, y_{n-2})
+    h[:, 2::2] = h[:, 1:4:2]
+    h[:, 1] = h[:, 0]
+    h[:, 3] = yn
 
-  for i in range(1, len(vals)):
-    smooth += -alpha * (smooth - vals[i])
-    smoothed.append(smooth.copy())
+    return yn
 
-  return np.array(smoothed)
+  def filter_block(self, vals):
+    """ Filters an (N, K) block of samples, continuing from the current state. """
+    vals = np.asarray(vals, dtype=float)
+    assert vals.ndim == 2 and vals.shape[1] == len(self)
+
+    out = np.empty_like(vals)
+    if not len(vals):
+      return out
+
+    b, a = self.b, self.a
+    h = self.hist
+    for k in range(len(self)):
+      zi = lfiltic(b[k], a[k], y=h[k, 3:], x=h[k, 1:3])
+      out[:, k], _ = lfilter(b[k], a[k], vals[:, k], zi=zi)
+
+    xs = np.vstack((h[:, 1], vals))
+    ys = np.vstack((h[:, 3], out))
+    h[:, 1], h[:, 2] = xs[-1], xs[-2]
+    h[:, 3], h[:, 4] = ys[-1], ys[-2]
+
+    return out
+
+class ExpSmoother:
+  """ Streaming exp_smooth """
+  def __init__(self, alpha):
+    self.alpha = alpha
+    self.zi = None
+
+  def push(self, val):
+    return self.push_block(np.asarray(val, dtype=float)[np.newaxis])[0]
+
+  def push_block(self, vals):
+    vals = np.asarray(vals, dtype=float)
+    smoothed = np.empty_like(vals)
+    if not len(vals):
+      return smoothed
+
+    start = 0
+    if self.zi is None:
+      smoothed[0] = vals[0]
+      # Filter state such that the output before vals[1] is vals[0]
+      self.zi = (1 - self.alpha) * vals[0][np.newaxis]
+      start = 1
+
+    # lfilter does not return a valid state for empty input.
+    if start < len(vals):
+      smoothed[start:], self.zi = lfilter([self.alpha], [1, self.alpha - 1], vals[start:], axis=0, zi=self.zi)
+
+    return smoothed
+
+@cached
+def exp_smooth(vals, alpha):
+  """ y_0 = x_0
+      y_t = (1 - alpha) y_{t-1} + alpha x_t
+  """
+  return ExpSmoother(alpha).push_block(vals)
 
 def biquad_notch(freq, fs, Q):
   om = 2 * np.pi * freq / fs
@@ -55,32 +153,180 @@ def biquad_notch(freq, fs, Q):
 
   return [n1, n2, n1], [1, n2, n3]
 
-@memory.cache
-def dynamic_rpm_notch(times, rpmtimes, vals, rpms, fs, Q=5.0):
+def _tv_biquad(b, a, x, state):
+  """
+    DF1 biquad whose coefficients change every sample, computed like DF1.filter.
+    The recursion is run sequentially on floats, since reassociating it (e.g. as a prefix scan)
+    loses accuracy when the poles are near z = 1, as for notches at low rpm.
+    b and a are (N, 3), x is (N, K) and state is (4, K) of (x_{n-1}, x_{n-2}, y_{n-1}, y_{n-2}),
+    which is updated in place.
+  """
+  b0s, b1s, b2s = np.asarray(b, dtype=float).T.tolist()
+  _, a1s, a2s = np.asarray(a, dtype=float).T.tolist()
+
+  y = np.empty_like(x)
+  for k in range(x.shape[1]):
+    xd1, xd2, yd1, yd2 = state[:, k].tolist()
+    ys = []
+    for b0, b1, b2, a1, a2, val in zip(b0s, b1s, b2s, a1s, a2s, x[:, k].tolist()):
+      yn = b0 * val + b1 * xd1 + b2 * xd2 - a1 * yd1 - a2 * yd2
+      xd2 = xd1
+      xd1 = val
+      yd2 = yd1
+      yd1 = yn
+      ys.append(yn)
+
+    y[:, k] = ys
+    state[:, k] = xd1, xd2, yd1, yd2
+
+  return y
+
+class TVBiquad:
+  """ Streaming DF1 biquad whose coefficients change every sample.
+      The recursion is sequential, so output does not depend on how the input is split across calls.
+  """
+  def __init__(self):
+    # (x_{n-1}, x_{n-2}, y_{n-1}, y_{n-2}) per channel
+    self.state = None
+
+  def filter(self, b, a, vals):
+    """ Filters vals with coefficients b and a of shape (N, 3) """
+    vals = np.asarray(vals, dtype=float)
+    if self.state is None:
+      self.state = np.zeros((4, int(np.prod(vals.shape[1:]))))
+
+    return _tv_biquad(b, a, vals.reshape(len(vals), -1), self.state).reshape(vals.shape)
+
+def notch_coefficients(freqs, fs, Q, prev=None):
+  """ Per sample biquad_notch coefficients for an array of frequencies.
+      Samples at or above the Nyquist frequency keep the previous coefficients,
+      which before the first valid sample are prev, or all ones.
+      Returns b and a of shape (N, 3) and the number of such samples.
+  """
+  freqs = np.asarray(freqs, dtype=float)
+  valid = freqs < fs / 2.0
+
+  # Index of the last valid frequency at or before each sample, -1 if none.
+  last = np.where(valid, np.arange(len(freqs)), -1)
+  np.maximum.accumulate(last, out=last)
+
+  b = np.ones((len(freqs), 3))
+  a = np.ones((len(freqs), 3))
+  if prev is not None:
+    b[:], a[:] = prev
+
+  have = last >= 0
+  bv, av = biquad_notch(freqs[last[have]], fs, Q)
+  b[have] = np.stack(np.broadcast_arrays(*bv), axis=-1)
+  a[have] = np.stack(np.broadcast_arrays(*av), axis=-1)
+
+  return b, a, np.count_nonzero(~valid)
+
+class DynamicRpmNotch:
+  """ Streaming dynamic_rpm_notch, with rpms given at the sample times,
+      either one per sample or (N, M) for M motors.
+  """
+  def __init__(self, fs, Q=5.0, harmonics=(1,)):
+    self.fs = fs
+    self.Q = Q
+    self.harmonics = harmonics
+
+    # (TVBiquad, last coefficients) per motor and harmonic
+    self.notches = None
+
+  def push(self, val, rpm):
+    """ push_block for one sample, on Python floats, giving the same output """
+    shape = np.shape(val)
+    xs = np.asarray(val, dtype=float).ravel().tolist()
+    rpms = np.asarray(rpm, dtype=float).ravel().tolist()
+    if self.notches is None:
+      self.notches = [[TVBiquad(), None] for _ in range(len(rpms) * len(self.harmonics))]
+
+    notches = iter(self.notches)
+    for rpmnow in rpms:
+      for harmonic, notch in zip(self.harmonics, notches):
+        filt, prev = notch
+        freq = harmonic * rpmnow / 60.0
+        if freq < self.fs / 2.0:
+          b, a = biquad_notch(freq, self.fs, self.Q)
+          b = float(b[0]), float(b[1]), float(b[2])
+          a = 1.0, float(a[1]), float(a[2])
+        else:
+          print("WARNING: RPM too high for notch filtering! %d" % rpmnow)
+          b, a = prev if prev is not None else ((1.0, 1.0, 1.0), (1.0, 1.0, 1.0))
+
+        notch[1] = b, a
+        if filt.state is None:
+          filt.state = np.zeros((4, len(xs)))
+
+        b0, b1, b2 = b
+        _, a1, a2 = a
+        xd1s, xd2s, yd1s, yd2s = filt.state.tolist()
+        ys = [b0 * val + b1 * xd1 + b2 * xd2 - a1 * yd1 - a2 * yd2
+              for val, xd1, xd2, yd1, yd2 in zip(xs, xd1s, xd2s, yd1s, yd2s)]
+        filt.state[:] = xs, xd1s, ys, yd1s
+        xs = ys
+
+    return np.array(xs).reshape(shape)[()]
+
+  def push_block(self, vals, rpms):
+    res = np.array(vals, dtype=float)
+    if not len(res):
+      return res
+
+    rpms = np.asarray(rpms, dtype=float).reshape(len(res), -1)
+    if self.notches is None:
+      self.notches = [[TVBiquad(), None] for _ in range(rpms.shape[1] * len(self.harmonics))]
+
+    notches = iter(self.notches)
+    for rpmnow in rpms.T:
+      for harmonic, notch in zip(self.harmonics, notches):
+        filt, prev = notch
+        b, a, n_high = notch_coefficients(harmonic * rpmnow / 60.0, self.fs, self.Q, prev)
+        if n_high:
+          print("WARNING: RPM too high for notch filtering at %d samples! %d" % (n_high, np.max(rpmnow)))
+
+        notch[1] = tuple(b[-1].tolist()), tuple(a[-1].tolist())
+        res = filt.filter(b, a, res)
+
+    return res
+
+@cached
+def dynamic_rpm_notch(times, rpmtimes, vals, rpms, fs, Q=5.0, harmonics=(1,)):
+  """ Notches vals at the rotor frequencies given by rpms.
+      rpms is (N,) or (N, M) for M motors; vals is (N,) or (N, ...).
+      One notch is cascaded per motor and harmonic.
+  """
   rpm_at_val_times = interp1d(rpmtimes, rpms, fill_value="extrapolate", axis=0)(times)
-  res = []
-  filt = DF1([1, 1, 1], [1, 1, 1])
-  for i, val in enumerate(vals):
-    rpmnow = rpm_at_val_times[i]
+  return DynamicRpmNotch(fs, Q, harmonics).push_block(vals, rpm_at_val_times)
 
-    freq = rpmnow / 60.0
-    if freq < fs / 2.0:
-      filt.b, filt.a = biquad_notch(freq, fs, Q)
+class StaticRpmNotch:
+  """ Streaming static_rpm_notch """
+  def __init__(self, rpm, fs, Q=5.0):
+    freq = rpm / 60.0
+    if freq >= fs / 2.0:
+      raise ValueError("RPM %d too high for notch filtering" % rpm)
 
-    else:
-      print("WARNING: RPM too high for notch filtering! %d" % rpmnow)
+    self.b, self.a = biquad_notch(freq, fs, Q)
+    self.zi = None
 
-    res.append(filt.filter(val))
+  def push(self, val):
+    return self.push_block(np.asarray(val, dtype=float)[np.newaxis])[0]
 
-  return np.array(res)
+  def push_block(self, vals):
+    vals = np.asarray(vals, dtype=float)
+    if not len(vals):
+      return vals.copy()
 
-@memory.cache
-def static_rpm_notch(vals, rpm, fs, Q=5.0):
-  freq = rpm / 60.0
-  if freq >= fs / 2.0:
-    raise "ERROR: RPM %d too high for notch filtering" % rpm
+    if self.zi is None:
+      self.zi = np.zeros((2,) + vals.shape[1:])
 
-  return lfilter(*biquad_notch(freq, fs, Q), vals, axis=0)
+    out, self.zi = lfilter(self.b, self.a, vals, axis=0, zi=self.zi)
+    return out
+
+@cached
+def static_rpm_notch(vals, rpm, fs, Q=5.0):
+  return StaticRpmNotch(rpm, fs, Q).push_block(vals)
 
 def pr_from_grav(grav):
   """ Returns pitch and roll from a matrix of gravity vectors in body frame """
@@ -88,65 +334,139 @@ def pr_from_grav(grav):
   pitches = np.arcsin(-grav[:, 0])
   return pitches, rolls
 
-@memory.cache
-def complementary_filter(weight, accs, gyros, dt, start_g=np.array((0, 0, 9.81))):
-  assert 0 <= weight <= 1
-  assert len(accs) == len(gyros)
-  assert len(start_g) == len(accs[0]) == len(gyros[0]) == 3
+def _unit_accs(accs, gyros, offset=0):
+  """ Returns accs normalized and a mask of the samples with too low a norm to normalize """
+  accs = np.asarray(accs, dtype=float)
+  norms = np.linalg.norm(accs, axis=1)
+  low = norms < 1e-9
+  for i in np.flatnonzero(low):
+    print("WARNING: Acc %d has low norm" % (offset + i), accs[i], gyros[i])
+
+  return accs / np.where(low, 1.0, norms)[:, np.newaxis], low
+
+def _complementary_kernel(weight, weight_bias, acc_units, low, gyros, dt, s, bias, ss, biases):
+  """
+    Complementary filter with gyro bias estimation, unrolled over the 3-vector components.
+    weight and weight_bias are either floats or (P,) arrays, in which case every set of gains
+    is run at once and ss and biases are (N, 3, P).
+    Writes the estimates into ss and biases and returns the final s and bias.
+  """
+  sx, sy, sz = s
+  bx, by, bz = bias
+  weight_c = 1 - weight
+  neg_weight_bias = -weight_bias
+
+  for i, ((ax, ay, az), (gx, gy, gz), is_low) in enumerate(zip(acc_units.tolist(), gyros.tolist(), low.tolist())):
+    gx = gx - bx
+    gy = gy - by
+    gz = gz - bz
+
+    # s + (s x gyro) dt
+    hx = sx + (sy * gz - sz * gy) * dt
+    hy = sy + (sz * gx - sx * gz) * dt
+    hz = sz + (sx * gy - sy * gx) * dt
+
+    if is_low:
+      ax, ay, az = sx, sy, sz
+
+    sx = weight * ax + weight_c * hx
+    sy = weight * ay + weight_c * hy
+    sz = weight * az + weight_c * hz
+    norm = (sx * sx + sy * sy + sz * sz) ** 0.5
+    sx = sx / norm
+    sy = sy / norm
+    sz = sz / norm
 
-  N = len(accs)
+    # Bias is driven by difference between acc estimate and gyro estimate
+    bx = bx + neg_weight_bias * (ay * hz - az * hy) * dt
+    by = by + neg_weight_bias * (az * hx - ax * hz) * dt
+    bz = bz + neg_weight_bias * (ax * hy - ay * hx) * dt
 
-  ss = np.empty((N, 3))
-  s = np.array(start_g)
+    ss[i] = sx, sy, sz
+    biases[i] = bx, by, bz
 
-  for i, (acc, gyro) in enumerate(zip(accs, gyros)):
-    s_gyro = s + np.cross(s, gyro) * dt
+  return np.array((sx, sy, sz)), np.array((bx, by, bz))
 
-    if np.linalg.norm(acc) < 1e-9:
-      s_acc = s
-      print("WARNING: Acc %d has low norm" % i, acc, gyro)
-    else:
-      s_acc = acc / np.linalg.norm(acc)
+class ComplementaryFilterBias:
+  """ Streaming complementary_filter_bias """
+  def __init__(self, weight, weight_bias, dt, start_g=np.array((0, 0, 9.81)), start_bias=np.zeros(3)):
+    assert 0 <= weight <= 1
+    assert weight_bias >= 0
+    assert len(start_g) == len(start_bias) == 3
 
-    s = weight * s_acc + (1 - weight) * s_gyro
-    s /= np.linalg.norm(s)
+    self.weight = float(weight)
+    self.weight_bias = float(weight_bias)
+    self.dt = dt
+    self.s = np.array(start_g, dtype=float)
+    self.bias = np.array(start_bias, dtype=float)
+    self.n = 0
 
-    ss[i] = s
+  def push(self, acc, gyro):
+    return tuple(v[0] for v in self.push_block(np.asarray(acc)[np.newaxis], np.asarray(gyro)[np.newaxis]))
 
-  return pr_from_grav(ss)
+  def push_block(self, accs, gyros):
+    """ Returns pitches, rolls and biases """
+    assert len(accs) == len(gyros)
 
-@memory.cache
-def complementary_filter_bias(weight, weight_bias, accs, gyros, dt, start_g=np.array((0, 0, 9.81)), start_bias=np.zeros(3)):
-  assert 0 <= weight <= 1
-  assert weight_bias >= 0
-  assert len(accs) == len(gyros)
-  assert len(start_g) == len(start_bias) == len(accs[0]) == len(gyros[0]) == 3
+    N = len(accs)
+    gyros = np.asarray(gyros, dtype=float)
+    acc_units, low = _unit_accs(accs, gyros, self.n)
 
-  N = len(accs)
+    ss = np.empty((N, 3))
+    biases = np.empty((N, 3))
+    self.s, self.bias = _complementary_kernel(self.weight, self.weight_bias, acc_units, low, gyros, self.dt,
+        self.s.tolist(), self.bias.tolist(), ss, biases)
+    self.n += N
 
-  ss = np.empty((N, 3))
-  biases = np.empty((N, 3))
-  s = np.array(start_g)
-  bias = np.array(start_bias)
+    pitches, rolls = pr_from_grav(ss)
 
-  for i, (acc, gyro) in enumerate(zip(accs, gyros)):
-    s_gyro = s + np.cross(s, gyro - bias) * dt
+    return pitches, rolls, biases
 
-    if np.linalg.norm(acc) < 1e-9:
-      s_acc = s
-      print("WARNING: Acc %d has low norm" % i, acc, gyro)
-    else:
-      s_acc = acc / np.linalg.norm(acc)
+class ComplementaryFilter(ComplementaryFilterBias):
+  """ Streaming complementary_filter """
+  def __init__(self, weight, dt, start_g=np.array((0, 0, 9.81))):
+    super().__init__(weight, 0.0, dt, start_g)
 
-    s = weight * s_acc + (1 - weight) * s_gyro
-    s /= np.linalg.norm(s)
+  def push_block(self, accs, gyros):
+    """ Returns pitches and rolls """
+    return super().push_block(accs, gyros)[:2]
 
-    # Bias is driven by difference between acc estimate and gyro estimate
-    bias += -weight_bias * np.cross(s_acc, s_gyro) * dt
+@cached
+def complementary_filter(weight, accs, gyros, dt, start_g=np.array((0, 0, 9.81))):
+  assert len(accs) == len(gyros)
+  assert len(accs[0]) == len(gyros[0]) == 3
+
+  return ComplementaryFilter(weight, dt, start_g).push_block(accs, gyros)
+
+@cached
+def complementary_filter_bias(weight, weight_bias, accs, gyros, dt, start_g=np.array((0, 0, 9.81)), start_bias=np.zeros(3)):
+  assert len(accs) == len(gyros)
+  assert len(accs[0]) == len(gyros[0]) == 3
+
+  return ComplementaryFilterBias(weight, weight_bias, dt, start_g, start_bias).push_block(accs, gyros)
+
+@cached
+def complementary_filter_sweep(weights, weight_biases, accs, gyros, dt, start_g=np.array((0, 0, 9.81)), start_bias=np.zeros(3)):
+  """ Runs complementary_filter_bias for every pair of (P,) weights and weight_biases in one pass.
+      Returns pitches and rolls of shape (N, P) and biases of shape (N, P, 3).
+  """
+  weights, weight_biases = np.broadcast_arrays(np.asarray(weights, dtype=float), np.asarray(weight_biases, dtype=float))
+  assert weights.ndim == 1
+  assert np.all((0 <= weights) & (weights <= 1))
+  assert np.all(weight_biases >= 0)
+  assert len(accs) == len(gyros)
+  assert len(start_g) == len(start_bias) == len(accs[0]) == len(gyros[0]) == 3
+
+  N = len(accs)
+  P = len(weights)
+  gyros = np.asarray(gyros, dtype=float)
+  acc_units, low = _unit_accs(accs, gyros)
 
-    ss[i] = s
-    biases[i] = bias.copy()
+  ss = np.empty((N, 3, P))
+  biases = np.empty((N, 3, P))
+  _complementary_kernel(weights, weight_biases, acc_units, low, gyros, dt,
+      np.array(start_g, dtype=float).tolist(), np.array(start_bias, dtype=float).tolist(), ss, biases)
 
-  pitches, rolls = pr_from_grav(ss)
+  pitches, rolls = pr_from_grav(ss.transpose(0, 2, 1).reshape(N * P, 3))
 
-  return pitches, rolls, biases
+  return pitches.reshape(N, P), rolls.reshape(N, P), biases.transpose(0, 2, 1)
@@ -1,3 +1,5 @@
+import math
+
 import numpy as np
 
 R_slice = (slice(3), slice(3))
@@ -64,34 +66,117 @@ def euler_matrix_intrinsic_zyx(yaw, pitch, roll):
   """ angles are in radians. """
   return R_z(yaw).dot(R_y(pitch)).dot(R_x(roll))
 
+def _components(x):
+  """ Unpackable components along the last axis of x.
+      Single samples give Python scalars, whose arithmetic is much faster than numpy's.
+  """
+  x = np.asarray(x)
+  return x.tolist() if x.ndim == 1 else np.moveaxis(x, -1, 0)
+
+def _stack_last(comps):
+  """ Sequence of (...) arrays to a (...) + (len(comps),) array """
+  if not isinstance(comps[0], np.ndarray):
+    # Much faster for single samples.
+    return np.array(comps)
+
+  return np.stack(np.broadcast_arrays(*comps), axis=-1)
+
+def _stack_matrix(rows):
+  """ 3 x 3 nested sequence of (...) arrays to a (..., 3, 3) array """
+  if not isinstance(rows[0][0], np.ndarray):
+    return np.array(rows)
+
+  return np.stack([_stack_last(row) for row in rows], axis=-2)
+
 def quat_mult(a, b):
-  return np.array((
-    a[0]*b[0] - a[1]*b[1] - a[2]*b[2] - a[3]*b[3],
-    a[0]*b[1] + a[1]*b[0] + a[2]*b[3] - a[3]*b[2],
-    a[0]*b[2] - a[1]*b[3] + a[2]*b[0] + a[3]*b[1],
-    a[0]*b[3] + a[1]*b[2] - a[2]*b[1] + a[3]*b[0]
+  """ a and b are (..., 4) """
+  a0, a1, a2, a3 = _components(a)
+  b0, b1, b2, b3 = _components(b)
+  return _stack_last((
+    a0*b0 - a1*b1 - a2*b2 - a3*b3,
+    a0*b1 + a1*b0 + a2*b3 - a3*b2,
+    a0*b2 - a1*b3 + a2*b0 + a3*b1,
+    a0*b3 + a1*b2 - a2*b1 + a3*b0
   ))
 
 def quat_rotate(quat, vec):
-  t = 2 * np.cross(quat[1:], vec)
-  return vec + quat[0] * t + np.cross(quat[1:], t)
+  """ quat is (..., 4) and vec is (..., 3) """
+  quat = np.asarray(quat)
+  if quat.ndim == 1 and np.ndim(vec) == 1:
+    w, x, y, z = quat.tolist()
+    vx, vy, vz = np.asarray(vec).tolist()
+    # t = 2 q_v x v and vec + w t + q_v x t
+    tx = 2 * (y * vz - z * vy)
+    ty = 2 * (z * vx - x * vz)
+    tz = 2 * (x * vy - y * vx)
+    return np.array((vx + w * tx + y * tz - z * ty, vy + w * ty + z * tx - x * tz, vz + w * tz + x * ty - y * tx))
+
+  t = 2 * np.cross(quat[..., 1:], vec)
+  return vec + quat[..., :1] * t + np.cross(quat[..., 1:], t)
 
 def quat_inverse(quat):
   quat_inv = quat.copy()
-  quat_inv[0] = -quat_inv[0]
+  if not isinstance(quat, np.ndarray) or quat.ndim == 1:
+    # Single samples may be lists.
+    quat_inv[0] = -quat_inv[0]
+  else:
+    quat_inv[..., 0] = -quat_inv[..., 0]
   return quat_inv
 
 def matrix_from_quat(q):
-  qw, qx, qy, qz = q
-  return np.array((
+  """ q is (..., 4), returns (..., 3, 3) """
+  qw, qx, qy, qz = _components(q)
+  return _stack_matrix((
     (1 - 2*qy**2 - 2*qz**2, 2*qx*qy - 2*qz*qw,     2*qx*qz + 2*qy*qw),
     (2*qx*qy + 2*qz*qw,     1 - 2*qx**2 - 2*qz**2, 2*qy*qz - 2*qx*qw),
     (2*qx*qz - 2*qy*qw,     2*qy*qz + 2*qx*qw,     1 - 2*qx**2 - 2*qy**2)
   ))
 
 def quat_from_axis_angle(axis, angle):
-  assert np.isclose(np.linalg.norm(axis), 1)
-  return np.hstack(((np.cos(angle / 2),), np.sin(angle / 2) * axis))
+  """ axis is (..., 3) and angle is (...) """
+  assert np.all(np.isclose(np.linalg.norm(axis, axis=-1), 1))
+  half = np.asarray(angle)[..., np.newaxis] / 2
+  vec = np.sin(half) * axis
+  if vec.ndim == 1:
+    return np.hstack((np.cos(half), vec))
+
+  return np.concatenate((np.broadcast_to(np.cos(half), vec.shape[:-1] + (1,)), vec), axis=-1)
+
+def quat_nlerp(q0, q1, t):
+  """ Normalized linear interpolation between unit quaternions.
+      q0 and q1 are (..., 4) and t is (...). Takes the shortest path.
+      Works for both scalar first and scalar last quaternions.
+  """
+  q0 = np.asarray(q0)
+  q1 = np.asarray(q1)
+  t = np.asarray(t)[..., np.newaxis]
+  q1 = np.where(np.sum(q0 * q1, axis=-1, keepdims=True) < 0, -q1, q1)
+
+  q = (1 - t) * q0 + t * q1
+  return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+def quat_slerp(q0, q1, t):
+  """ Spherical linear interpolation between unit quaternions.
+      q0 and q1 are (..., 4) and t is (...). Takes the shortest path.
+      Works for both scalar first and scalar last quaternions.
+  """
+  q0 = np.asarray(q0)
+  q1 = np.asarray(q1)
+  t = np.asarray(t)[..., np.newaxis]
+  q1 = np.where(np.sum(q0 * q1, axis=-1, keepdims=True) < 0, -q1, q1)
+
+  # More accurate than arccos of the dot product for small angles.
+  ang = 2 * np.arctan2(np.linalg.norm(q0 - q1, axis=-1, keepdims=True), np.linalg.norm(q0 + q1, axis=-1, keepdims=True))
+  sin_ang = np.sin(ang)
+
+  # Use linear weights when the quaternions are (nearly) equal.
+  small = sin_ang < 1e-9
+  sin_ang = np.where(small, 1.0, sin_ang)
+  w0 = np.where(small, 1 - t, np.sin((1 - t) * ang) / sin_ang)
+  w1 = np.where(small, t, np.sin(t * ang) / sin_ang)
+
+  q = w0 * q0 + w1 * q1
+  return q / np.linalg.norm(q, axis=-1, keepdims=True)
 
 def quat_identity():
   return np.array((1., 0., 0., 0.))
@@ -100,16 +185,21 @@ def vector_quat(v):
   return np.array((0, v[0], v[1], v[2]))
 
 def skew_matrix(v):
-  return np.array(((0, -v[2], v[1]),
-                   (v[2], 0, -v[0]),
-                   (-v[1], v[0], 0)))
+  """ v is (..., 3), returns (..., 3, 3) """
+  v0, v1, v2 = _components(v)
+  zero = np.zeros_like(v0) if isinstance(v0, np.ndarray) else 0
+  return _stack_matrix(((zero, -v2, v1),
+                        (v2, zero, -v0),
+                        (-v1, v0, zero)))
 
 def hat(v):
   return skew_matrix(v)
 
 def vee(m):
-  assert np.allclose(m.T, -m)
-  return np.array((-m[1, 2], m[0, 2], -m[0, 1]))
+  """ m is (..., 3, 3) and skew symmetric, returns (..., 3) """
+  m = np.asarray(m)
+  assert np.allclose(np.swapaxes(m, -1, -2), -m)
+  return _stack_last((-m[..., 1, 2], m[..., 0, 2], -m[..., 0, 1]))
 
 def axis_from_quat(q):
   return q[1:] / np.linalg.norm(q[1:])
@@ -137,21 +227,135 @@ def avgang(angs):
   """ Angles in radians. Returns "average" angle using unit vector method """
   return np.arctan2(np.sum(np.sin(angs)), np.sum(np.cos(angs)))
 
-def rodmat(k):
-  ang = np.linalg.norm(k)
-  if ang < 1e-9:
-    return np.eye(3)
+# Below this angle (in radians) the exp and log maps use truncated Taylor series.
+series_angle = 1e-4
+
+def _rodrigues_coeffs(ang2):
+  """ sin(x) / x and (1 - cos(x)) / x^2 for x^2 = ang2 """
+  small = ang2 < series_angle ** 2
+  ang = np.sqrt(np.where(small, 1.0, ang2))
+  half_sinc = np.sin(ang / 2) / ang
+  a = np.where(small, 1 - ang2 / 6 * (1 - ang2 / 20), np.sin(ang) / ang)
+  b = np.where(small, 0.5 - ang2 / 24 * (1 - ang2 / 30), 2 * half_sinc ** 2)
+  return a, b
+
+def so3_exp(k):
+  """ Rotation matrices (..., 3, 3) from rotation vectors k (..., 3), i.e. expm(hat(k)) """
+  k = np.asarray(k, dtype=float)
+  if k.ndim == 1:
+    # Python floats are much faster for single samples.
+    x, y, z = k.tolist()
+    ang2 = x * x + y * y + z * z
+    if ang2 < series_angle ** 2:
+      a = 1 - ang2 / 6 * (1 - ang2 / 20)
+      b = 0.5 - ang2 / 24 * (1 - ang2 / 30)
+    else:
+      ang = math.sqrt(ang2)
+      half_sinc = math.sin(0.5 * ang) / ang
+      a = math.sin(ang) / ang
+      b = 2 * half_sinc * half_sinc
+
+    c = 1 - b * ang2
+    return np.array((
+      (c + b * x * x,     b * x * y - a * z, b * x * z + a * y),
+      (b * x * y + a * z, c + b * y * y,     b * y * z - a * x),
+      (b * x * z - a * y, b * y * z + a * x, c + b * z * z)
+    ))
+
+  ang2 = np.sum(k * k, axis=-1)
+  a, b = _rodrigues_coeffs(ang2)
+  a = a[..., np.newaxis, np.newaxis]
+  b = b[..., np.newaxis, np.newaxis]
+
+  # hat(k)^2 = k k^T - |k|^2 I
+  kkT = k[..., :, np.newaxis] * k[..., np.newaxis, :]
+  return (1 - b * ang2[..., np.newaxis, np.newaxis]) * np.eye(3) + a * hat(k) + b * kkT
+
+def so3_log(rot):
+  """ Rotation vectors (..., 3) with angles in [0, pi] from rotation matrices (..., 3, 3) """
+  rot = np.asarray(rot, dtype=float)
+
+  # sin(ang) * axis and cos(ang)
+  s = 0.5 * np.stack((rot[..., 2, 1] - rot[..., 1, 2], rot[..., 0, 2] - rot[..., 2, 0], rot[..., 1, 0] - rot[..., 0, 1]), axis=-1)
+  sin = np.linalg.norm(s, axis=-1)
+  cos = 0.5 * (np.trace(rot, axis1=-2, axis2=-1) - 1)
+  ang = np.arctan2(sin, cos)
+
+  small = ang < series_angle
+  ang2 = ang ** 2
+  # sin is also 0 at exactly pi, which is handled below.
+  scale = np.where(small, 1 + ang2 / 6 * (1 + 7 * ang2 / 60), ang / np.where(small | (sin == 0), 1.0, sin))
+  k = scale[..., np.newaxis] * s
+
+  # Near pi, sin is tiny and the axis is better found from the symmetric part,
+  # (rot + rot^T) / 2 = cos I + (1 - cos) axis axis^T.
+  near_pi = cos < -0.99
+  if np.any(near_pi):
+    sym = 0.5 * (rot[near_pi] + np.swapaxes(rot[near_pi], -1, -2))
+    cos_pi = cos[near_pi][..., np.newaxis, np.newaxis]
+    outer = (sym - cos_pi * np.eye(3)) / (1 - cos_pi)
+    diag = np.diagonal(outer, axis1=-2, axis2=-1)
+    col = np.argmax(diag, axis=-1)
+    axis = np.take_along_axis(outer, col[..., np.newaxis, np.newaxis], axis=-1)[..., 0]
+    axis /= np.linalg.norm(axis, axis=-1, keepdims=True)
+    sign = np.where(np.sum(axis * s[near_pi], axis=-1) < 0, -1.0, 1.0)
+    k[near_pi] = (sign * ang[near_pi])[..., np.newaxis] * axis
+
+  return k
+
+def quat_exp(v):
+  """ Unit quaternions (..., 4) from rotation vectors v (..., 3)
+      See "Practical Parameterization of Rotations Using the Exponential Map"
+      - F. Sebastian Grassia
+      Section 3
+  """
+  v = np.asarray(v, dtype=float)
+  if v.ndim == 1:
+    x, y, z = v.tolist()
+    ang2 = x * x + y * y + z * z
+    ang = math.sqrt(ang2)
+    if ang2 < series_angle ** 2:
+      sc = 0.5 - ang2 / 48 * (1 - ang2 / 80)
+    else:
+      sc = math.sin(0.5 * ang) / ang
+
+    return np.array((math.cos(0.5 * ang), sc * x, sc * y, sc * z))
+
+  ang2 = np.sum(v * v, axis=-1)
+  small = ang2 < series_angle ** 2
+  ang = np.sqrt(ang2)
+  # sin(ang / 2) / ang
+  sc = np.where(small, 0.5 - ang2 / 48 * (1 - ang2 / 80), np.sin(0.5 * ang) / np.where(small, 1.0, ang))
+
+  return np.concatenate((np.cos(0.5 * ang)[..., np.newaxis], sc[..., np.newaxis] * v), axis=-1)
+
+def quat_log(q):
+  """ Rotation vectors (..., 3) with angles in [0, pi] from unit quaternions (..., 4) """
+  q = np.asarray(q, dtype=float)
+  # q and -q are the same rotation, use the one with the smaller angle.
+  q = np.where(q[..., :1] < 0, -q, q)
+  w = q[..., 0]
+  n = np.linalg.norm(q[..., 1:], axis=-1)
+
+  small = n < series_angle
+  # ang / n for ang = 2 atan2(n, w), with the denominators guarded since np.where evaluates both branches.
+  w_small = np.where(small, w, 1.0)
+  scale = np.where(small, 2 / w_small * (1 - (n / w_small) ** 2 / 3), 2 * np.arctan2(n, w) / np.where(small, 1.0, n))
+  return scale[..., np.newaxis] * q[..., 1:]
 
-  K = hat(k / ang)
-  return np.eye(3) + np.sin(ang) * K + (1 - np.cos(ang)) * K.dot(K)
+def rodmat(k):
+  """ k is (..., 3), returns (..., 3, 3) """
+  return so3_exp(k)
 
 def rodrot(k, v):
-  ang = np.linalg.norm(k)
-  ax = k / ang
+  """ k and v are (..., 3) """
+  k = np.asarray(k, dtype=float)
+  ang = np.linalg.norm(k, axis=-1, keepdims=True)
+  ax = k / np.where(ang < 1e-9, 1.0, ang)
 
   c = np.cos(ang)
   s = np.sin(ang)
-  return v * c + np.cross(ax, v) * s + ax.dot(v) * (1 - c) * ax
+  return v * c + np.cross(ax, v) * s + np.sum(ax * v, axis=-1, keepdims=True) * (1 - c) * ax
 
 def rot_from_z_yaw_zyx(z, yaw):
   """ Yaw as defined via Euler angles ZYX """
@@ -174,11 +378,14 @@ def rot_from_z_yaw_zxy(z, yaw):
 def normalized(v):
   return v / np.linalg.norm(v)
 
-def numerical_jacobian(f, xs, dx=1e-6):
+def numerical_jacobian(f, xs, dx=1e-6, central=False, batched=False):
   """
       f is a function that accepts input of shape (n_points, input_dim)
       and outputs (n_points, output_dim)
 
+      central uses central instead of forward differences.
+      batched stacks all perturbed inputs into a single call to f.
+
       return the jacobian as (n_points, output_dim, input_dim)
   """
   if len(xs.shape) == 1:
@@ -186,46 +393,97 @@ def numerical_jacobian(f, xs, dx=1e-6):
 
   assert len(xs.shape) == 2
 
-  ys = f(xs)
+  n_points, x_dim = xs.shape
+  steps = dx * np.eye(x_dim)
+
+  if central:
+    x_tries = [xs + step for step in steps] + [xs - step for step in steps]
+  else:
+    x_tries = [xs + step for step in steps] + [xs]
+
+  if batched:
+    ys = f(np.concatenate(x_tries))
+    ys = ys.reshape((len(x_tries), n_points) + ys.shape[1:])
+  else:
+    ys = [f(x_try) for x_try in x_tries]
 
-  x_dim = xs.shape[1]
-  y_dim = ys.shape[1]
+  y_dim = ys[0].shape[1]
 
-  jac = np.empty((xs.shape[0], y_dim, x_dim))
+  jac = np.empty((n_points, y_dim, x_dim))
 
   for i in range(x_dim):
-    x_try = xs + dx * e(x_dim, i + 1)
-    jac[:, :, i] = (f(x_try) - ys) / dx
+    if central:
+      jac[:, :, i] = (ys[i] - ys[x_dim + i]) / (2 * dx)
+    else:
+      jac[:, :, i] = (ys[i] - ys[-1]) / dx
 
   return jac
 
-def numerical_grad_mani(f, x, x_dim, f_addhat, dx=1e-6):
+def numerical_grad_mani(f, x, x_dim, f_addhat, dx=1e-6, central=False, map_f=map):
   """
       Assuming f outputs elements in a Euclidean space,
       but input x may be on a manifold.
       f_addhat(x, dx) = x + hat(dx), where + is addition on the manifold.
       hat(dx) should project from the lie algebra to the manifold
+
+      central uses central instead of forward differences.
+      map_f(f, points) evaluates f at all perturbed points, e.g. pass
+      the map of a concurrent.futures executor to evaluate them in parallel.
   """
-  y = f(x)
+  steps = dx * np.eye(x_dim)
 
-  assert len(y.shape) <= 1
-  y_dim = y.shape[0] if len(y.shape) == 1 else 1
+  points = [f_addhat(x, step) for step in steps]
+  if central:
+    points += [f_addhat(x, -step) for step in steps]
+  else:
+    points.append(x)
 
-  grad = np.empty((y_dim, x_dim))
-  for i in range(x_dim):
-    Dx = dx * e(x_dim, i + 1)
-    grad[:, i] = (f(f_addhat(x, Dx)) - y) / dx
+  ys = np.array(list(map_f(f, points)))
+  assert len(ys.shape) <= 2
 
-  if grad.shape[0] == 1:
+  if central:
+    grad = (ys[:x_dim] - ys[x_dim:]) / (2 * dx)
+  else:
+    grad = (ys[:x_dim] - ys[-1]) / dx
+
+  # Rows of grad are input dimensions so far.
+  grad = grad.T
+  if grad.ndim == 2 and grad.shape[0] == 1:
     return grad[0]
 
   return grad
 
-def numerical_hess_mani(f, x, x_dim, f_addhat, dx=1e-6):
-  def gradf(x):
-    return numerical_grad_mani(f, x, x_dim, f_addhat, dx=dx)
+def numerical_hess_mani(f, x, x_dim, f_addhat, dx=1e-6, central=False, map_f=map):
+  """
+      Hessian of scalar f, as the numerical_grad_mani of numerical_grad_mani,
+      but with every evaluation of f made in one call to map_f.
+  """
+  steps = dx * np.eye(x_dim)
+
+  if central:
+    signed_steps = np.concatenate((steps, -steps))
+    outer = [f_addhat(x, step) for step in signed_steps]
+    points = [f_addhat(xj, step) for xj in outer for step in signed_steps]
+
+    # ys[a, j, b, i] = f((x + s_a Dx_j) + s_b Dx_i)
+    ys = np.array(list(map_f(f, points))).reshape(2, x_dim, 2, x_dim)
+    grads = (ys[:, :, 0] - ys[:, :, 1]) / (2 * dx)
+    return ((grads[0] - grads[1]) / (2 * dx)).T
+
+  outer = [x] + [f_addhat(x, step) for step in steps]
+  points = outer + [f_addhat(xj, step) for xj in outer[1:] for step in steps]
+
+  ys = np.array(list(map_f(f, points)))
+  assert ys.ndim == 1
+
+  y0 = ys[0]
+  # yj[j] = f(x + Dx_j) and yji[j, i] = f((x + Dx_j) + Dx_i)
+  yj = ys[1:x_dim + 1]
+  yji = ys[x_dim + 1:].reshape(x_dim, x_dim)
 
-  return numerical_grad_mani(gradf, x, x_dim, f_addhat, dx=dx)
+  grad = (yj - y0) / dx
+  grads = (yji - yj[:, np.newaxis]) / dx
+  return ((grads - grad) / dx).T
 
 def gradient_descent_mani(f, x, f_addhat, alpha, maxiter=10000, min_cost_change=1e-10, min_grad_norm=1e-6, print_progress=False, debug_grad=False, show_hessian=False, print_callback=print):
   """
@@ -252,7 +510,7 @@ def gradient_descent_mani(f, x, f_addhat, alpha, maxiter=10000, min_cost_change=
         print("Small change in cost, exiting.")
       break
 
-    prev_cost = prev_cost
+    prev_cost = cost
 
     x = f_addhat(x, -alpha * grad)
 
@@ -0,0 +1,183 @@
+""" Optimizers for costs on manifolds.
+
+    Like mathu.gradient_descent_mani, these take a retraction
+      f_addhat(x, dx) = x + hat(dx)
+    where dx is in the Lie algebra (a vector) and + is addition on the manifold.
+    Each returns the solution and an OptimStats.
+"""
+
+import time
+
+import numpy as np
+
+from python_utils.mathu import numerical_grad_mani
+
+class OptimStats:
+  """ Per iteration costs and wall clock times, and counts of function evaluations """
+  def __init__(self):
+    self.costs = []
+    self.iter_times = []
+    self.evals = dict()
+    self.converged = False
+    self.message = ""
+
+  @property
+  def iterations(self):
+    return len(self.iter_times)
+
+  def counted(self, func, name):
+    """ Wraps func to count its calls in evals[name] """
+    self.evals.setdefault(name, 0)
+    def wrapper(*args, **kwargs):
+      self.evals[name] += 1
+      return func(*args, **kwargs)
+
+    return wrapper
+
+  def finish(self, converged, message):
+    self.converged = converged
+    self.message = message
+    return self
+
+  def __repr__(self):
+    evals = ", ".join("%s: %d" % item for item in self.evals.items())
+    return "%s after %d iterations (%.3f s), final cost %g, evals: %s" % (
+        self.message, self.iterations, sum(self.iter_times), self.costs[-1] if self.costs else np.nan, evals)
+
+def gradient_descent(f, x, f_addhat, alpha, momentum=0.0, nesterov=False, line_search=False, cost_f=None,
+                     maxiter=1000, min_cost_change=1e-10, min_grad_norm=1e-6, armijo_c=1e-4, shrink=0.5,
+                     print_progress=False, print_callback=print):
+  """
+     f(x) = (cost, gradient)
+
+     Steps along d = momentum * d_prev - gradient, restarting from the gradient
+     whenever d is not a descent direction.
+     nesterov evaluates the gradient at the momentum lookahead point instead.
+     Without line_search the step is alpha * d.
+     With line_search the step length starts from twice the previous one (at most alpha)
+     and backtracks by shrink until the Armijo condition holds. This needs costs only,
+     from cost_f(x) if given, else from f.
+  """
+  assert not (nesterov and line_search), "Nesterov momentum is not supported with line search"
+
+  stats = OptimStats()
+  f = stats.counted(f, "f")
+  cost_f = stats.counted(cost_f, "cost") if cost_f is not None else lambda x: f(x)[0]
+
+  d = None
+  step_len = alpha
+  cost, grad = f(x)
+
+  for iterno in range(maxiter):
+    start_time = time.time()
+
+    if nesterov and d is not None:
+      lookahead = f_addhat(x, momentum * step_len * d)
+      _, grad = f(lookahead)
+
+    if np.linalg.norm(grad) < min_grad_norm:
+      return x, stats.finish(True, "Gradient small")
+
+    d = -grad if d is None else momentum * d - grad
+    if np.dot(d, grad) >= 0:
+      d = -grad
+
+    if line_search:
+      step_len = min(2 * step_len, alpha)
+      slope = np.dot(d, grad)
+      while True:
+        x_new = f_addhat(x, step_len * d)
+        cost_new = cost_f(x_new)
+        if cost_new <= cost + armijo_c * step_len * slope or step_len < 1e-20:
+          break
+        step_len *= shrink
+
+    else:
+      x_new = f_addhat(x, step_len * d)
+
+    x = x_new
+    prev_cost = cost
+    cost, grad = f(x)
+
+    stats.costs.append(cost)
+    stats.iter_times.append(time.time() - start_time)
+
+    if print_progress:
+      print_callback(iterno, cost, x)
+
+    if abs(cost - prev_cost) < min_cost_change:
+      return x, stats.finish(True, "Small change in cost")
+
+  return x, stats.finish(False, "maxiter = %d reached" % maxiter)
+
+def levenberg_marquardt(r, x, x_dim, f_addhat, jac=None, lam=1e-3, lam_up=10.0, lam_down=0.1,
+                        maxiter=100, min_cost_change=1e-12, min_step_norm=1e-12, dx=1e-6, map_f=map,
+                        print_progress=False, print_callback=print):
+  """
+     Minimizes 0.5 |r(x)|^2 for residuals r(x) of shape (m,).
+
+     jac(x) returns the (m, x_dim) Jacobian of r(f_addhat(x, dx)) w.r.t. dx at dx = 0.
+     If not given it is computed numerically, evaluating r with map_f (see numerical_grad_mani).
+
+     Each step solves (J^T J + lam I) dx = -J^T r. Steps that decrease the cost are
+     taken and decrease lam, others are rejected and increase it.
+     lam = 0 gives Gauss-Newton, where rejected steps are halved instead.
+  """
+  stats = OptimStats()
+  if jac is None:
+    residual = r
+    def jac(x):
+      # map_f gets the uncounted residual, since it may pickle it to other processes.
+      stats.evals["residual"] += x_dim + 1
+      return numerical_grad_mani(residual, x, x_dim, f_addhat, dx=dx, map_f=map_f).reshape(-1, x_dim)
+
+  r = stats.counted(r, "residual")
+  jac = stats.counted(jac, "jacobian")
+
+  res = np.atleast_1d(r(x))
+  cost = 0.5 * res.dot(res)
+
+  for iterno in range(maxiter):
+    start_time = time.time()
+
+    J = jac(x)
+    JtJ = J.T.dot(J)
+    Jtr = J.T.dot(res)
+
+    step_scale = 1.0
+    while True:
+      step = -step_scale * np.linalg.solve(JtJ + lam * np.eye(x_dim), Jtr)
+      x_new = f_addhat(x, step)
+      res_new = np.atleast_1d(r(x_new))
+      cost_new = 0.5 * res_new.dot(res_new)
+
+      if cost_new < cost or np.linalg.norm(step) < min_step_norm:
+        break
+
+      if lam:
+        lam *= lam_up
+      else:
+        step_scale *= 0.5
+
+    stats.iter_times.append(time.time() - start_time)
+
+    if cost_new >= cost:
+      stats.costs.append(cost)
+      return x, stats.finish(True, "Step small")
+
+    x, res = x_new, res_new
+    prev_cost, cost = cost, cost_new
+    lam *= lam_down
+    stats.costs.append(cost)
+
+    if print_progress:
+      print_callback(iterno, cost, x)
+
+    if prev_cost - cost < min_cost_change:
+      return x, stats.finish(True, "Small change in cost")
+
+  return x, stats.finish(False, "maxiter = %d reached" % maxiter)
+
+def gauss_newton(r, x, x_dim, f_addhat, jac=None, **kwargs):
+  """ levenberg_marquardt without damping, halving steps that do not decrease the cost """
+  return levenberg_marquardt(r, x, x_dim, f_addhat, jac=jac, lam=0.0, **kwargs)
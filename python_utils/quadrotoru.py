@@ -1,6 +1,7 @@
 import numpy as np
 
-from python_utils.mathu import skew_matrix
+from python_utils.mathu import e3, quat_identity, quat_rotate, skew_matrix
+from python_utils.rigid_body import RigidBody3DBatch
 
 class Quadrotor:
   """
@@ -38,6 +39,8 @@ class Quadrotor:
     for k, v in kwargs.items():
       setattr(self, k, v)
 
+    self._scalar = None
+
   def _zvecfromrpm(self, rpms):
     """ (1) Converts to radians per second
         (2) Sums accoriding to motor directions
@@ -85,6 +88,77 @@ class Quadrotor:
 
     return angacc
 
+  def _scalar_params(self):
+    """ Model constants as Python floats for angaccel_single """
+    coeffs = self.motor_thrust.coeffs
+    assert len(coeffs) <= 3, "angaccel_single supports thrust models of degree 2 at most"
+    thrust_coeffs = np.concatenate((np.zeros(3 - len(coeffs)), coeffs))
+
+    return (
+      tuple(thrust_coeffs.tolist()),
+      tuple(self.motor_dirs.tolist()),
+      tuple(map(tuple, self.mixer.tolist())),
+      tuple(self.com_thrust_torque[:, 0].tolist()),
+      float(self.motor_I[2, 2]),
+      tuple(map(tuple, self.I.tolist())),
+      tuple(map(tuple, self.I_inv.tolist())),
+    )
+
+  def angaccel_single(self, rpms, angvel_in_body, rpmsd=None, out=None):
+    """ angaccel for one sample, given as length 4 and length 3 sequences, written into out (3,).
+        Unrolled on Python floats to avoid the temporaries of the array version.
+        Constants are taken from the model on first call; changes to it after that are not seen.
+    """
+    if self._scalar is None:
+      self._scalar = self._scalar_params()
+    (a, b, c), (d0, d1, d2, d3), mixer, (ct0, ct1, ct2), Ir, I, I_inv = self._scalar
+
+    if out is None:
+      out = np.empty(3)
+
+    r0, r1, r2, r3 = rpms
+    p, q, r = angvel_in_body
+
+    f0 = (a * r0 + b) * r0 + c
+    f1 = (a * r1 + b) * r1 + c
+    f2 = (a * r2 + b) * r2 + c
+    f3 = (a * r3 + b) * r3 + c
+
+    m = mixer[0]
+    thrust = m[0] * f0 + m[1] * f1 + m[2] * f2 + m[3] * f3
+    m = mixer[1]
+    t0 = m[0] * f0 + m[1] * f1 + m[2] * f2 + m[3] * f3
+    m = mixer[2]
+    t1 = m[0] * f0 + m[1] * f1 + m[2] * f2 + m[3] * f3
+    m = mixer[3]
+    t2 = m[0] * f0 + m[1] * f1 + m[2] * f2 + m[3] * f3
+
+    # Gyroscopic torque -omega x (0, 0, I_r omega_r)
+    h = Ir * (d0 * r0 + d1 * r1 + d2 * r2 + d3 * r3) / 60.0
+    t0 += -q * h
+    t1 += p * h
+
+    if rpmsd is not None:
+      rd0, rd1, rd2, rd3 = rpmsd
+      t2 -= Ir * (d0 * rd0 + d1 * rd1 + d2 * rd2 + d3 * rd3) / 60.0
+
+    t0 -= ct0 * thrust
+    t1 -= ct1 * thrust
+    t2 -= ct2 * thrust
+
+    # Euler term omega x I omega
+    Iw0 = I[0][0] * p + I[0][1] * q + I[0][2] * r
+    Iw1 = I[1][0] * p + I[1][1] * q + I[1][2] * r
+    Iw2 = I[2][0] * p + I[2][1] * q + I[2][2] * r
+    t0 -= q * Iw2 - r * Iw1
+    t1 -= r * Iw0 - p * Iw2
+    t2 -= p * Iw1 - q * Iw0
+
+    out[0] = I_inv[0][0] * t0 + I_inv[0][1] * t1 + I_inv[0][2] * t2
+    out[1] = I_inv[1][0] * t0 + I_inv[1][1] * t1 + I_inv[1][2] * t2
+    out[2] = I_inv[2][0] * t0 + I_inv[2][1] * t1 + I_inv[2][2] * t2
+    return out
+
   def rotorforces_from_accels(self, zaccel, angaccel, angvel_in_body=None):
     """ NOTE: Does not consider com, rotor accel torque, or gyro torque """
     thrust = self.mass * zaccel
@@ -97,10 +171,115 @@ class Quadrotor:
     return self.mixer_inv.dot(wrench.T).T
 
   def rpms_from_rotorforces(self, rf):
-    flatrf = rf.flatten()
-    flatrpm = np.array([np.max((self.motor_thrust - f).roots) for f in flatrf])
-    return flatrpm.reshape(rf.shape)
+    """ Inverts the thrust model for rotor forces of any shape, taking the larger root.
+        Forces below the minimum of the thrust curve (negative discriminant)
+        give the rpm at the minimum.
+    """
+    coeffs = self.motor_thrust.coeffs
+    a, b, c = np.concatenate((np.zeros(3 - len(coeffs)), coeffs))
+    c = c - np.asarray(rf, dtype=float)
+
+    if a == 0:
+      return -c / b
+
+    disc = b ** 2 - 4 * a * c
+    below_min = disc < 0
+    sqrt_disc = np.sqrt(np.where(below_min, 0.0, disc))
+
+    # Roots as q / a and c / q, avoiding cancellation between b and sqrt_disc.
+    # Below the minimum q / a = -b / 2a is the vertex, and c / q is not a root.
+    q = -0.5 * (b + np.copysign(sqrt_disc, b))
+    root1 = q / a
+    with np.errstate(divide='ignore', invalid='ignore'):
+      root2 = np.where((q == 0) | below_min, root1, c / q)
+
+    return np.maximum(root1, root2)
 
   def rpms_from_accels(self, zaccel, angaccel, angvel_in_body=None):
     rotorforces = self.rotorforces_from_accels(zaccel, angaccel, angvel_in_body)
     return self.rpms_from_rotorforces(rotorforces)
+
+class QuadrotorBatchSim:
+  """
+    Simulates n Quadrotors in parallel.
+
+    Rotor speeds follow the rpm commands through a first order lag with time constant motor_tau.
+    Thrust acts along body z and gravity along world -z.
+    Angular velocity is in the body frame; everything else is as in RigidBody3D.
+    rpms and commands are (n, 4); initial values can be given per quadrotor or shared.
+  """
+  def __init__(self, quad, n, motor_tau=0.03, gravity=9.81, pos=np.zeros(3), vel=np.zeros(3), quat=quat_identity(), ang=np.zeros(3), rpms=np.zeros(4)):
+    self.quad = quad
+    self.n = n
+    self.motor_tau = motor_tau
+    self.gravity = gravity
+
+    self.body = RigidBody3DBatch(n, pos, vel, quat, ang, in_body=True)
+    self.rpms = np.array(np.broadcast_to(rpms, (n, 4)), dtype=float)
+
+  def hover_rpm(self):
+    return self.quad.rpms_from_rotorforces(self.quad.mass * self.gravity / 4)
+
+  def step(self, dt, rpm_cmds):
+    """ Accelerations use the rotor speeds at the start of the step, like RigidBody3D.step """
+    lag = 1.0 if self.motor_tau == 0 else 1 - np.exp(-dt / self.motor_tau)
+    rpms = self.rpms + lag * (rpm_cmds - self.rpms)
+    rpmsd = (rpms - self.rpms) / dt
+
+    angaccel = self.quad.angaccel(rpms=self.rpms, angvel_in_body=self.body.ang, rpmsd=rpmsd).T
+
+    thrust = self.quad.motor_thrust(self.rpms).dot(self.quad.mixer[0])
+    accel = (thrust / self.quad.mass)[:, np.newaxis] * quat_rotate(self.body.quat, e3)
+    accel[:, 2] -= self.gravity
+
+    self.body.step(dt, accel, angaccel)
+    self.rpms = rpms
+
+if __name__ == "__main__":
+  import time
+
+  quad = Quadrotor(
+    mass=0.8,
+    motor_thrust_coeffs=[1.5e-7, 2e-5, -0.02],
+    motor_torque_scale=0.01,
+    inertia=np.diag((3e-3, 3e-3, 5e-3)),
+    motor_arm_length=0.12,
+    motor_spread_angle=np.pi / 4,
+    motor_inertia=2e-6
+  )
+
+  rpms = quad.rpms_from_rotorforces(np.full(4, quad.mass * 9.81 / 4)) + np.array((100.0, -50.0, 30.0, 0.0))
+  rpmsd = np.array((1e4, -2e4, 5e3, 0.0))
+  angvel = np.array((1.0, -2.0, 3.0))
+  out = np.empty(3)
+
+  N = 20000
+  t1 = time.process_time()
+  for i in range(N):
+    angacc = quad.angaccel(rpms=rpms[np.newaxis], angvel_in_body=angvel[np.newaxis], rpmsd=rpmsd[np.newaxis])
+  t_array = (time.process_time() - t1) / N
+
+  rpms_l, angvel_l, rpmsd_l = rpms.tolist(), angvel.tolist(), rpmsd.tolist()
+  t1 = time.process_time()
+  for i in range(N):
+    quad.angaccel_single(rpms_l, angvel_l, rpmsd_l, out=out)
+  t_single = (time.process_time() - t1) / N
+
+  print("angaccel single sample: array %.1f us, angaccel_single %.1f us, max diff %g" % (
+      1e6 * t_array, 1e6 * t_single, np.max(np.abs(angacc[:, 0] - out))))
+
+  dt = 0.002
+  steps = 500
+
+  print("Throughput (quadrotor steps per second)")
+  for n in [1, 100, 10000]:
+    sim = QuadrotorBatchSim(quad, n)
+    sim.rpms[:] = sim.hover_rpm()
+    cmds = sim.hover_rpm() + 50 * np.random.normal(size=(steps, n, 4))
+
+    t1 = time.process_time()
+    for i in range(steps):
+      sim.step(dt, cmds[i])
+    elapsed = time.process_time() - t1
+
+    print("\tn = %5d: %10.0f (%.1f us per step)" % (n, n * steps / elapsed, 1e6 * elapsed / steps))
@@ -1,22 +1,11 @@
 import numpy as np
 
-from python_utils.mathu import quat_identity, quat_mult, vector_quat, matrix_from_quat, rodmat
+from python_utils.mathu import quat_identity, quat_mult, vector_quat, matrix_from_quat, rodmat, quat_exp
 
 from scipy.spatial.transform import Rotation as R
 
 def exp_quat(v):
-  """ See "Practical Parameterization of Rotations Using the Exponential Map"
-      - F. Sebastian Grassia
-      Section 3
-  """
-  ang = np.linalg.norm(v)
-  hang = 0.5 * ang
-  if ang < 1e-8: # Threshold probably too conservative (too low)
-    sc = 0.5 + ang ** 2 / 48
-  else:
-    sc = np.sin(hang) / ang
-
-  return np.array((np.cos(hang), sc * v[0], sc * v[1], sc * v[2]))
+  return quat_exp(v)
 
 def euler_int(dt, vel, accel):
   return vel * dt + 0.5 * accel * dt ** 2
@@ -43,9 +32,71 @@ def so3_rot_int(rot, dang, dang_in_body):
   """ Uses exponential map for rotation matrices """
   delta_rot = rodmat(dang)
   if dang_in_body:
-    return rot.dot(delta_rot)
+    return rot @ delta_rot
 
-  return delta_rot.dot(rot)
+  return delta_rot @ rot
+
+def dexpinv_so3(theta, omega, in_body):
+  """ Rate of theta giving angular velocity omega, for the attitude exp(theta) * X0,
+      or X0 * exp(theta) if in_body. Truncated after the second order term,
+      which is sufficient for fourth order RKMK.
+  """
+  tw = np.cross(theta, omega)
+  return omega + (0.5 if in_body else -0.5) * tw + np.cross(theta, tw) / 12.0
+
+class Integrators(object):
+  """
+    Integration with state dependent accelerations for RigidBody3D and RigidBody3DRot.
+    accel_f(pos, vel, att, ang) returns (accel, ang_accel),
+    where att is the attitude in the body's representation (quat or rot).
+
+    Methods:
+      euler: The scheme of step, with accelerations from the start of the step.
+      verlet: (Lie-)Verlet, i.e. kick-drift-kick leapfrog, symplectic for accelerations
+              that do not depend on velocity. 2 calls of accel_f per step.
+      rk4: Classical Runge-Kutta for pos, vel and ang, with Runge-Kutta-Munthe-Kaas
+           on the rotation group for the attitude. 4 calls of accel_f per step.
+  """
+  def integrate(self, dt, accel_f, method="rk4"):
+    getattr(self, "_integrate_" + method)(dt, accel_f)
+
+  def _integrate_euler(self, dt, accel_f):
+    self.step(dt, *accel_f(self.pos, self.vel, getattr(self, self.att_name), self.ang))
+
+  def _integrate_verlet(self, dt, accel_f):
+    att = getattr(self, self.att_name)
+    accel, ang_accel = accel_f(self.pos, self.vel, att, self.ang)
+    vel = self.vel + 0.5 * dt * accel
+    ang = self.ang + 0.5 * dt * ang_accel
+
+    self.pos = self.pos + dt * vel
+    att = self.att_int(att, dt * ang, self.in_body)
+    setattr(self, self.att_name, att)
+
+    # Velocities at the end of the step are extrapolated with the first kick,
+    # which keeps second order accuracy for velocity dependent accelerations.
+    accel, ang_accel = accel_f(self.pos, vel + 0.5 * dt * accel, att, ang + 0.5 * dt * ang_accel)
+    self.vel = vel + 0.5 * dt * accel
+    self.ang = ang + 0.5 * dt * ang_accel
+
+  def _integrate_rk4(self, dt, accel_f):
+    pos, vel, att, ang = self.pos, self.vel, getattr(self, self.att_name), self.ang
+
+    def deriv(dpos, dvel, theta, dang):
+      """ Derivatives of pos, vel, theta and ang at the state offset by the arguments """
+      accel, ang_accel = accel_f(pos + dpos, vel + dvel, self.att_int(att, theta, self.in_body), ang + dang)
+      return vel + dvel, accel, dexpinv_so3(theta, ang + dang, self.in_body), ang_accel
+
+    k1 = deriv(0, 0, np.zeros_like(ang), 0)
+    k2 = deriv(*(0.5 * dt * k for k in k1))
+    k3 = deriv(*(0.5 * dt * k for k in k2))
+    k4 = deriv(*(dt * k for k in k3))
+    dpos, dvel, theta, dang = (dt / 6.0 * (a + 2 * b + 2 * c + d) for a, b, c, d in zip(k1, k2, k3, k4))
+
+    self.pos = pos + dpos
+    self.vel = vel + dvel
+    setattr(self, self.att_name, self.att_int(att, theta, self.in_body))
+    self.ang = ang + dang
 
 class AttitudeNoLie(object):
   def __init__(self, quat=quat_identity(), ang=np.zeros(3), in_body=False):
@@ -68,8 +119,7 @@ class AttitudeNoLie(object):
     return self.ang.copy()
 
   def set_rot(self, rot):
-    quat = R.from_matrix(rot).as_quat()
-    self.quat = np.array((quat[3], quat[0], quat[1], quat[2]))
+    self.quat = R.from_matrix(rot).as_quat()[..., [3, 0, 1, 2]]
 
 class Attitude(object):
   def __init__(self, quat=quat_identity(), ang=np.zeros(3), in_body=False):
@@ -92,8 +142,7 @@ class Attitude(object):
     return self.ang.copy()
 
   def set_rot(self, rot):
-    quat = R.from_matrix(rot).as_quat()
-    self.quat = np.array((quat[3], quat[0], quat[1], quat[2]))
+    self.quat = R.from_matrix(rot).as_quat()[..., [3, 0, 1, 2]]
 
 class AttitudeRot(object):
   def __init__(self, quat=quat_identity(), ang=np.zeros(3), in_body=False):
@@ -115,7 +164,7 @@ class AttitudeRot(object):
   def set_rot(self, rot):
     self.rot = rot
 
-class RigidBody3D(object):
+class RigidBody3D(Integrators):
   """
     quat transforms body to world.
     ang and ang_accel are in the world frame and radians (unless in_body=True).
@@ -123,6 +172,9 @@ class RigidBody3D(object):
 
     Uses exponential map for quaternions.
   """
+  att_name = "quat"
+  att_int = staticmethod(so3_quat_int)
+
   def __init__(self, pos=np.zeros(3), vel=np.zeros(3), quat=quat_identity(), ang=np.zeros(3), in_body=False):
     self.pos = pos.copy()
     self.vel = vel.copy()
@@ -154,10 +206,9 @@ class RigidBody3D(object):
     return self.ang.copy()
 
   def set_rot(self, rot):
-    quat = R.from_matrix(rot).as_quat()
-    self.quat = np.array((quat[3], quat[0], quat[1], quat[2]))
+    self.quat = R.from_matrix(rot).as_quat()[..., [3, 0, 1, 2]]
 
-class RigidBody3DRot(object):
+class RigidBody3DRot(Integrators):
   """
     rot transforms body to world.
     ang and ang_accel are in the world frame and radians (unless in_body=True).
@@ -165,6 +216,9 @@ class RigidBody3DRot(object):
 
     Use Exponential Map for rotation matrices (SO(3)).
   """
+  att_name = "rot"
+  att_int = staticmethod(so3_rot_int)
+
   def __init__(self, pos=np.zeros(3), vel=np.zeros(3), quat=quat_identity(), ang=np.zeros(3), in_body=False):
     self.pos = pos.copy()
     self.vel = vel.copy()
@@ -195,6 +249,34 @@ class RigidBody3DRot(object):
   def set_rot(self, rot):
     self.rot = rot
 
+def _tile(n, val, shape):
+  """ n copies of val, which has the given shape or is already (n,) + shape """
+  return np.array(np.broadcast_to(val, (n,) + shape), dtype=float)
+
+class AttitudeBatch(Attitude):
+  """
+    n Attitudes stepped together in one vectorized call.
+    quat is (n, 4) and ang is (n, 3); initial values and accelerations
+    can be given for all bodies, or once for every body.
+  """
+  def __init__(self, n, quat=quat_identity(), ang=np.zeros(3), in_body=False):
+    super().__init__(_tile(n, quat, (4,)), _tile(n, ang, (3,)), in_body)
+
+class AttitudeRotBatch(AttitudeRot):
+  """ n AttitudeRots stepped together, rot is (n, 3, 3) """
+  def __init__(self, n, quat=quat_identity(), ang=np.zeros(3), in_body=False):
+    super().__init__(_tile(n, quat, (4,)), _tile(n, ang, (3,)), in_body)
+
+class RigidBody3DBatch(RigidBody3D):
+  """ n RigidBody3Ds stepped together, see AttitudeBatch """
+  def __init__(self, n, pos=np.zeros(3), vel=np.zeros(3), quat=quat_identity(), ang=np.zeros(3), in_body=False):
+    super().__init__(_tile(n, pos, (3,)), _tile(n, vel, (3,)), _tile(n, quat, (4,)), _tile(n, ang, (3,)), in_body)
+
+class RigidBody3DRotBatch(RigidBody3DRot):
+  """ n RigidBody3DRots stepped together, rot is (n, 3, 3) """
+  def __init__(self, n, pos=np.zeros(3), vel=np.zeros(3), quat=quat_identity(), ang=np.zeros(3), in_body=False):
+    super().__init__(_tile(n, pos, (3,)), _tile(n, vel, (3,)), _tile(n, quat, (4,)), _tile(n, ang, (3,)), in_body)
+
 if __name__ == "__main__":
   import time
 
@@ -251,3 +333,35 @@ if __name__ == "__main__":
   print("Avg time per step (us)")
   for s, _, ts in data:
     print("\t%s: %f (%f std)" % (s, 1e6 * np.mean(ts), 1e6 * np.std(ts)))
+
+  n_bodies = 1000
+  aa_bodies = np.random.normal(size=(n_bodies, 3))
+  print("Avg time per body per step, %d bodies (us)" % n_bodies)
+  for s, batch in [("Quat w/ Exp. Map", AttitudeBatch(n_bodies)), ("SO(3) w/ Exp. Map", AttitudeRotBatch(n_bodies))]:
+    t1 = time.process_time()
+    for i in range(100):
+      batch.step(dt, ang_accel=aa_bodies)
+    print("\t%s: %f" % (s, 1e6 * (time.process_time() - t1) / (100 * n_bodies)))
+
+  # Torque free tumbling of an asymmetric body on a spring.
+  inertia = np.array((1.0, 2.0, 3.0))
+  def accel_f(pos, vel, rot, ang):
+    return -4.0 * pos, -np.cross(ang, inertia * ang) / inertia
+
+  def simulate(method, dt, T=5.0):
+    body = RigidBody3DRot(pos=np.array((1.0, 0, 0)), vel=np.array((0, 1.0, 0)), ang=np.array((1.0, 0.2, 0.5)), in_body=True)
+    t1 = time.process_time()
+    for i in range(int(round(T / dt))):
+      body.integrate(dt, accel_f, method)
+    return body, time.process_time() - t1
+
+  ref, _ = simulate("rk4", 5e-4)
+
+  print("Integrator accuracy after 5 s vs. wall clock")
+  print("\t%-8s %8s %14s %14s %12s %10s" % ("method", "dt", "att. err (deg)", "pos. err (m)", "us / step", "total (s)"))
+  for method in ["euler", "verlet", "rk4"]:
+    for dt in [0.001, 0.01, 0.05]:
+      body, total = simulate(method, dt)
+      att_err = np.degrees(np.linalg.norm(R.from_matrix(ref.rot.T @ body.rot).as_rotvec()))
+      pos_err = np.linalg.norm(body.pos - ref.pos)
+      print("\t%-8s %8.3f %14.2e %14.2e %12.1f %10.3f" % (method, dt, att_err, pos_err, 1e6 * total * dt / 5.0, total))
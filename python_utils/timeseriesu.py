@@ -1,9 +1,16 @@
+import os
+import pickle
+
+from collections import OrderedDict
+
 import numpy as np
 
 from scipy.spatial.transform import Rotation as R
 
+from python_utils.mathu import quat_slerp
+
 def apply_f_to_ts(src, f):
-  for k, data in src.__dict__.items():
+  for k, data in list(src.items()):
     if isinstance(data, TimeSeries):
       src[k] = f(data)
       setattr(src, k, src[k])
@@ -13,7 +20,7 @@ def apply_f_to_ts(src, f):
 
 def trans_data(src, dest, f):
   # Ideally, this meta data should not be in the same namespace as the data.
-  forbidden_keys = ["times", "meta_times", "metadata", "finalized", "t0"]
+  forbidden_keys = ["times", "meta_times", "metadata", "finalized", "t0", "columnar", "times_sorted"]
   if not hasattr(src, '__dict__'):
     if type(src) is dict:
       for k, data in src.items():
@@ -50,8 +57,7 @@ def f_retimed(ts, newts, **kwargs):
       return Slerp(ts, data)(newts)
     elif len(data) and type(data[0]) == type(R.identity()):
       # Keep this in case we are using lists.
-      rots = R.from_matrix([rot.as_matrix() for rot in data])
-      return Slerp(ts, rots)(newts)
+      return Slerp(ts, concatenate_rotations(data))(newts)
     elif len(data) and type(data[0]) in [str, np.str_, bytes, np.bytes_]:
       print(f"WARNING: interpolating with non numericals not well supported (copying first: {data[0]})")
       # I wish interp1d with kind='nearest' works here.
@@ -61,16 +67,30 @@ def f_retimed(ts, newts, **kwargs):
 
   return f
 
-def f_masked(mask):
+def concatenate_rotations(rots):
+  """ Returns a single Rotation object (backed by one quaternion array) from a list of Rotations. """
+  if hasattr(R, 'concatenate'):
+    return R.concatenate(rots)
+
+  return R.from_quat(np.vstack([rot.as_quat() for rot in rots]))
+
+def f_masked(mask, n=None):
+  """ mask is a boolean mask, an index array or a slice over n samples. """
+  if isinstance(mask, slice):
+    inds = None
+  else:
+    mask = np.asarray(mask)
+    if n is None:
+      n = len(mask)
+    inds = np.flatnonzero(mask) if mask.dtype == bool else mask
+
   def f(data, mask=mask):
     # Only to deal with numpy Rotation bug
     if isinstance(data, list):
-      if len(data) == len(mask):
-        new_list = []
-        for i, x in enumerate(data):
-          if mask[i]:
-            new_list.append(x)
-        return new_list
+      if n is None or len(data) == n:
+        if inds is None:
+          return data[mask]
+        return [data[i] for i in inds]
       return data
 
     # For any auxiliary vars that may have been added...
@@ -81,21 +101,273 @@ def f_masked(mask):
 
   return f
 
+class Retimer:
+  """
+    Linear interpolation (and extrapolation) from times oldts to times newts,
+    using the same formula as interp1d, but with the bracketing indices and
+    weights computed once and shared by every field.
+  """
+  def __init__(self, oldts, newts):
+    inds = np.clip(np.searchsorted(oldts, newts), 1, len(oldts) - 1)
+    self.lo = inds - 1
+    self.hi = inds
+    self.dx = (oldts[self.hi] - oldts[self.lo])[:, np.newaxis]
+    self.xoff = (newts - oldts[self.lo])[:, np.newaxis]
+    self.n_old = len(oldts)
+    self.n_new = len(newts)
+
+  def accepts(self, data):
+    return isinstance(data, np.ndarray) and data.dtype.kind in 'biufc' and data.ndim >= 1 and len(data) == self.n_old
+
+  def __call__(self, data):
+    # interp1d always returns float64 or complex128.
+    dtype = np.complex128 if data.dtype.kind == 'c' else np.float64
+    flat = data.reshape(self.n_old, -1)
+
+    y_lo = np.take(flat, self.lo, axis=0).astype(dtype, copy=False)
+    out = np.take(flat, self.hi, axis=0).astype(dtype, copy=False)
+    out -= y_lo
+    out /= self.dx
+    out *= self.xoff
+    out += y_lo
+
+    return out.reshape((self.n_new,) + data.shape[1:])
+
+  def slerp(self, quats):
+    """ Interpolates unit quaternions (N, 4) along the shortest path, using the same brackets as __call__. """
+    return quat_slerp(quats[self.lo], quats[self.hi], (self.xoff / self.dx)[:, 0])
+
+retimer_cache = OrderedDict()
+retimer_cache_size = 8
+
+def get_retimer(oldts, newts, **kwargs):
+  """ Returns a (cached) Retimer for interpolating from oldts to newts with interp1d kwargs,
+      or None if the kwargs or times are not supported by Retimer.
+      Cache entries are matched by content, so e.g. syncwith calls for several series
+      with the same target times reuse the same weights.
+  """
+  kind = kwargs.pop('kind', 'linear')
+  fill_value = kwargs.pop('fill_value', None)
+  kwargs.pop('assume_sorted', None)
+  kwargs.pop('copy', None)
+  kwargs.pop('bounds_error', None)
+  if kwargs or kind != 'linear' or fill_value not in (None, 'extrapolate') or len(oldts) < 2:
+    return None
+
+  oldts = np.asarray(oldts)
+  newts = np.asarray(newts)
+  key = (fill_value, len(oldts), oldts[0], oldts[-1], len(newts), newts[0] if len(newts) else None, newts[-1] if len(newts) else None)
+  if key in retimer_cache:
+    cached_oldts, cached_newts, retimer = retimer_cache[key]
+    if np.array_equal(cached_oldts, oldts) and np.array_equal(cached_newts, newts):
+      retimer_cache.move_to_end(key)
+      return retimer
+
+  if not np.all(oldts[1:] > oldts[:-1]):
+    return None
+
+  if fill_value is None and len(newts) and (newts.min() < oldts[0] or newts.max() > oldts[-1]):
+    # Without extrapolation, let interp1d raise or fill as usual.
+    return None
+
+  retimer = Retimer(oldts, newts)
+  # Copies, so that editing the times in place cannot make a stale entry match.
+  retimer_cache[key] = (oldts.copy(), newts.copy(), retimer)
+  if len(retimer_cache) > retimer_cache_size:
+    retimer_cache.popitem(last=False)
+
+  return retimer
+
 def retimed_copy(src, dest, oldts, newts, **kwargs):
-  return trans_data(src, dest, f_retimed(oldts, newts, **kwargs))
+  f = f_retimed(oldts, newts, **kwargs)
+  retimer = get_retimer(oldts, newts, **kwargs)
+  if retimer is None:
+    return trans_data(src, dest, f)
+
+  def f_fast(data):
+    if retimer.accepts(data):
+      return retimer(data)
+
+    if len(data) == retimer.n_old and (type(data) is R or isinstance(data, list) and all(type(rot) is R for rot in data)):
+      rots = data if type(data) is R else concatenate_rotations(data)
+      return R.from_quat(retimer.slerp(rots.as_quat()))
+
+    return f(data)
+
+  return trans_data(src, dest, f_fast)
+
+def masked_copy(src, dest, mask, n=None):
+  return trans_data(src, dest, f_masked(mask, n))
+
+def index_from_ranges(starts, ends):
+  """ Converts half-open index ranges into a slice if they cover a contiguous range
+      and into a sorted index array otherwise.
+  """
+  ranges = sorted((s, e) for s, e in zip(starts, ends) if e > s)
+  if not ranges:
+    return slice(0, 0)
+
+  merged = [list(ranges[0])]
+  for s, e in ranges[1:]:
+    if s <= merged[-1][1]:
+      merged[-1][1] = max(merged[-1][1], e)
+    else:
+      merged.append([s, e])
+
+  if len(merged) == 1:
+    return slice(*merged[0])
 
-def masked_copy(src, dest, mask):
-  return trans_data(src, dest, f_masked(mask))
+  return np.concatenate([np.arange(s, e) for s, e in merged])
+
+def compose_index(n, outer, inner):
+  """ Returns an index into n samples equivalent to indexing with outer and then with inner. """
+  if isinstance(outer, slice) and isinstance(inner, slice):
+    r = range(n)[outer][inner]
+    if r.step > 0:
+      return slice(r.start, r.stop, r.step)
+
+  return np.arange(n)[outer][inner]
 
 class BasicAttrDict(dict):
   pass
 
+class LazyDict(dict):
+  """ dict whose values are f(src[k]), computed on first access.
+      Computed values are stored (as both items and attributes) if cache is True.
+      Keys set directly on the LazyDict take precedence over src.
+  """
+  def _init_lazy(self, src, f, cache=True):
+    object.__setattr__(self, '_src', src)
+    object.__setattr__(self, '_f', f)
+    object.__setattr__(self, '_cache', cache)
+
+  def __missing__(self, k):
+    v = self._f(self._src[k])
+    if self._cache:
+      dict.__setitem__(self, k, v)
+      object.__setattr__(self, k, v)
+
+    return v
+
+  def __getattr__(self, k):
+    if k.startswith('_'):
+      raise AttributeError(k)
+
+    try:
+      return self[k]
+    except KeyError:
+      raise AttributeError(k) from None
+
+  def __contains__(self, k):
+    return dict.__contains__(self, k) or k in self._src
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    return len(self.keys())
+
+  def keys(self):
+    return list(self._src) + [k for k in dict.keys(self) if k not in self._src]
+
+  def values(self):
+    return [self[k] for k in self.keys()]
+
+  def items(self):
+    return [(k, self[k]) for k in self.keys()]
+
+  def get(self, k, default=None):
+    return self[k] if k in self else default
+
+class LazyAttrDict(BasicAttrDict, LazyDict):
+  def __init__(self, src, f, cache=True):
+    super().__init__()
+    self._init_lazy(src, f, cache)
+
+class ColumnBuffer(list):
+  """ Growable numpy buffer used for columnar ingest.
+      dtype and shape are inferred from the first value.
+      Values are appended to the list itself, which keeps append as cheap as for a plain list,
+      and are moved into numpy storage by flush(), so the number of boxed values stays bounded.
+      If chunk_size is None, the storage doubles in size when full,
+      otherwise full chunks of chunk_size rows are kept and concatenated in finalize.
+  """
+  def __init__(self, first, chunk_size=None, block_size=1024):
+    super().__init__()
+    first = np.asarray(first)
+    self.dtype = first.dtype
+    self.shape = first.shape
+    self.chunk_size = chunk_size
+    self.block_size = chunk_size or block_size
+    self.chunks = []
+    self.buf = np.empty((self.block_size,) + self.shape, dtype=self.dtype)
+    self.n = 0
+
+  @staticmethod
+  def supports(val):
+    """ Only numeric values can be stored; anything else should go in a list. """
+    return np.asarray(val).dtype.kind in 'biufc'
+
+  def __len__(self):
+    return sum(len(chunk) for chunk in self.chunks) + self.n + list.__len__(self)
+
+  def full(self):
+    return list.__len__(self) >= self.block_size
+
+  def _reserve(self, k):
+    """ Makes room for k more rows in buf. """
+    if self.n + k <= len(self.buf):
+      return
+
+    if self.chunk_size is None:
+      newbuf = np.empty((max(2 * len(self.buf), self.n + k),) + self.shape, dtype=self.dtype)
+      newbuf[:self.n] = self.buf[:self.n]
+      self.buf = newbuf
+    else:
+      self.chunks.append(self.buf[:self.n])
+      self.buf = np.empty((max(self.chunk_size, k),) + self.shape, dtype=self.dtype)
+      self.n = 0
+
+  def write(self, vals):
+    """ Writes an array of rows directly to numpy storage. Pending values must be flushed first. """
+    vals = np.asarray(vals)
+    if vals.shape[1:] != self.shape:
+      raise ValueError("Expected values of shape %s, got %s" % (self.shape, vals.shape[1:]))
+
+    # Avoid silently truncating e.g. floats appended to a column that started as ints.
+    if not np.can_cast(vals.dtype, self.dtype):
+      self.dtype = np.result_type(self.dtype, vals.dtype)
+      self.chunks = [chunk.astype(self.dtype) for chunk in self.chunks]
+      self.buf = self.buf.astype(self.dtype)
+
+    k = len(vals)
+    self._reserve(k)
+    self.buf[self.n:self.n + k] = vals
+    self.n += k
+
+  def flush(self):
+    if list.__len__(self):
+      self.write(self[:])
+      del self[:]
+
+  def finalize(self):
+    self.flush()
+
+    if not self.chunks:
+      # A copy, since a view would keep the slack of a doubled buffer alive.
+      return self.buf[:self.n].copy() if len(self.buf) > self.n else self.buf
+
+    return np.concatenate(self.chunks + [self.buf[:self.n]])
+
 class DataSet(dict):
   def __setattr__(self, k, v):
     self[k] = v
     object.__setattr__(self, k, v)
 
-  def _item_map(self, f):
+  def _item_map(self, f, lazy=False):
+    if lazy:
+      return DataSetView(self, f)
+
     ret = DataSet()
     for k, v in self.items():
       ret[k] = f(v)
@@ -103,49 +375,226 @@ class DataSet(dict):
 
     return ret
 
-  def add_point(self, key, delim='/', ts_metadata=None, **data):
-    key = key.strip(delim)
+  def _get_series(self, key, delim, ts_metadata, ts_columnar):
+    """ Returns the TimeSeries at key, creating it and any intermediate DataSets if needed.
+        Resolved keys are cached, so each key string is only parsed once.
+        The cache assumes series are not replaced or deleted while adding points.
+    """
+    cache = self.__dict__.setdefault('_series_cache', {})
+    ts = cache.get((key, delim))
+    if ts is not None:
+      return ts
 
-    del_ind = key.find(delim)
-    if del_ind != -1:
-      fkey = key[:del_ind]
-      if fkey not in self:
-        self[fkey] = DataSet()
-        setattr(self, fkey, self[fkey])
+    parts = [part for part in key.split(delim) if part]
 
-      self[fkey].add_point(key[del_ind + 1:], delim=delim, ts_metadata=ts_metadata, **data)
+    d = self
+    for part in parts[:-1]:
+      if part not in d:
+        d[part] = DataSet()
+        setattr(d, part, d[part])
 
-    else:
-      if key not in self:
-        self[key] = TimeSeries(metadata=ts_metadata)
-        setattr(self, key, self[key])
+      d = d[part]
+
+    name = parts[-1]
+    if name not in d:
+      d[name] = TimeSeries(metadata=ts_metadata, columnar=ts_columnar)
+      setattr(d, name, d[name])
+
+    ts = cache[(key, delim)] = d[name]
+    return ts
+
+  def add_point(self, key, delim='/', ts_metadata=None, ts_columnar=False, **data):
+    """ ts_columnar is passed to any newly created TimeSeries (see TimeSeries). """
+    self._get_series(key, delim, ts_metadata, ts_columnar).add_point(**data)
 
-      self[key].add_point(**data)
+  def add_points(self, key, times, delim='/', ts_metadata=None, ts_columnar=False, **arrays):
+    """ Batch version of add_point; see TimeSeries.add_points. """
+    self._get_series(key, delim, ts_metadata, ts_columnar).add_points(times, **arrays)
+
+  def method_map(self, method_name, *args, lazy=False):
+    """ If lazy, the method is called (with lazy=True) on each item only when that item is accessed. """
+    if lazy:
+      return self._item_map(lambda obj, args=args: getattr(obj, method_name)(*args, lazy=True), lazy=True)
 
-  def method_map(self, method_name, *args):
     return self._item_map(lambda obj, args=args: getattr(obj, method_name)(*args))
 
-  def get_view(self, start_time, end_time):
-    return self.method_map('get_view', start_time, end_time)
+  def get_view(self, start_time, end_time, lazy=False):
+    return self.method_map('get_view', start_time, end_time, lazy=lazy)
+
+  def get_after(self, start_time, lazy=False):
+    return self.method_map('get_after', start_time, lazy=lazy)
+
+  def get_before(self, end_time, lazy=False):
+    return self.method_map('get_before', end_time, lazy=lazy)
+
+  def get_multiview(self, mask, lazy=False):
+    return self.method_map('get_multiview', mask, lazy=lazy)
+
+  def get_window(self, start_time, end_time, lazy=False):
+    return self.method_map('get_window', start_time, end_time, lazy=lazy)
 
-  def get_after(self, start_time):
-    return self.method_map('get_after', start_time)
+  def time_range(self):
+    """ Returns the earliest and latest time over all series, or None if there are no times. """
+    ranges = [v.time_range() for v in self.values()]
+    ranges = [r for r in ranges if r is not None]
+    if not ranges:
+      return None
 
-  def get_before(self, end_time):
-    return self.method_map('get_before', end_time)
+    return min(r[0] for r in ranges), max(r[1] for r in ranges)
 
-  def get_multiview(self, mask):
-    return self.method_map('get_multiview', mask)
+  def iter_chunks(self, chunk_seconds=10):
+    """ Yields DataSets with the same key tree as this one, covering consecutive
+        time windows of chunk_seconds (see TimeSeries.get_window).
+        Sorted series are sliced without copying, so with a memory mapped DataSet
+        (see DataSet.load) only the current chunk needs to be in memory.
+    """
+    time_range = self.time_range()
+    if time_range is None:
+      return
+
+    tmin, tmax = time_range
+    n_chunks = int(np.floor((tmax - tmin) / chunk_seconds)) + 1
+    # Open ended first and last windows so that rounding cannot drop samples.
+    bounds = np.hstack((-np.inf, tmin + chunk_seconds * np.arange(1, n_chunks), np.inf))
+
+    for start_time, end_time in zip(bounds[:-1], bounds[1:]):
+      yield self.get_window(start_time, end_time)
 
   def finalize(self):
     [v.finalize() for v in self.values()]
 
+  def save(self, path):
+    """ Saves a finalized DataSet to the directory path.
+        Each array is written as a .npy file in path/arrays and
+        the key structure, times and metadata go in path/manifest.pkl.
+        See DataSet.load.
+    """
+    os.makedirs(os.path.join(path, 'arrays'), exist_ok=True)
+    manifest = save_node(self, path, [0])
+    with open(os.path.join(path, 'manifest.pkl'), 'wb') as f:
+      pickle.dump(manifest, f)
+
+  @staticmethod
+  def load(path, mmap_mode='r'):
+    """ Loads a DataSet written by DataSet.save.
+        Arrays are memory mapped (unless mmap_mode is None),
+        so only the parts that are accessed are read from disk.
+    """
+    with open(os.path.join(path, 'manifest.pkl'), 'rb') as f:
+      manifest = pickle.load(f)
+
+    return load_node(manifest, path, mmap_mode)
+
+def _unpickle_view(obj):
+  """ Views are pickled as the objects returned by their materialize method. """
+  return obj
+
+class DataSetView(DataSet, LazyDict):
+  """ DataSet whose items are f(src[k]), computed when first accessed. """
+  def __init__(self, src, f, cache=True):
+    super().__init__()
+    self._init_lazy(src, f, cache)
+
+  def materialize(self):
+    """ Returns a DataSet with all items computed. Views in it remain views. """
+    ret = DataSet()
+    for k, v in self.items():
+      setattr(ret, k, v)
+
+    return ret
+
+  def __reduce__(self):
+    # f is usually a closure, so pickle the computed items instead.
+    return _unpickle_view, (self.materialize(),)
+
+def iter_chunks(path, chunk_seconds=10):
+  """ Streams a DataSet saved with DataSet.save in time ordered chunks (see DataSet.iter_chunks). """
+  return DataSet.load(path).iter_chunks(chunk_seconds)
+
+def save_leaf(data, path, counter):
+  if type(data) is R:
+    kind, data = 'rotation', data.as_quat()
+  elif isinstance(data, np.ndarray) and data.dtype != object:
+    kind = 'array'
+  else:
+    # Lists, object arrays and auxiliary values are stored in the manifest.
+    return dict(kind='object', value=data)
+
+  fname = os.path.join('arrays', '%d.npy' % counter[0])
+  counter[0] += 1
+  np.save(os.path.join(path, fname), data)
+  return dict(kind=kind, file=fname)
+
+def save_node(obj, path, counter):
+  if isinstance(obj, DataSet):
+    return dict(kind='dataset', items=[(k, save_node(v, path, counter)) for k, v in obj.items()])
+
+  if isinstance(obj, TimeSeries):
+    assert obj.finalized
+    header = dict(
+      metadata=obj.metadata,
+      times_sorted=getattr(obj, 'times_sorted', False),
+      times=save_leaf(obj.times, path, counter),
+      meta_times=save_leaf(obj.meta_times, path, counter),
+    )
+    if hasattr(obj, 't0'):
+      header['t0'] = obj.t0
+
+    return dict(kind='timeseries', header=header, items=[(k, save_node(v, path, counter)) for k, v in obj.items()])
+
+  if isinstance(obj, dict):
+    return dict(kind='dict', items=[(k, save_node(v, path, counter)) for k, v in obj.items()])
+
+  return save_leaf(obj, path, counter)
+
+def load_node(node, path, mmap_mode):
+  kind = node['kind']
+  if kind == 'object':
+    return node['value']
+  if kind == 'array':
+    return np.load(os.path.join(path, node['file']), mmap_mode=mmap_mode)
+  if kind == 'rotation':
+    return R.from_quat(np.load(os.path.join(path, node['file'])))
+
+  if kind == 'dataset':
+    ret = DataSet()
+  elif kind == 'timeseries':
+    header = node['header']
+    ret = TimeSeries(metadata=header['metadata'])
+    ret.finalized = True
+    ret.times_sorted = header['times_sorted']
+    ret.times = load_node(header['times'], path, mmap_mode)
+    ret.meta_times = load_node(header['meta_times'], path, mmap_mode)
+    if 't0' in header:
+      ret.t0 = header['t0']
+  else:
+    ret = BasicAttrDict()
+
+  for k, v in node['items']:
+    ret[k] = load_node(v, path, mmap_mode)
+    setattr(ret, k, ret[k])
+
+  return ret
+
+def column_array(vals):
+  if isinstance(vals, ColumnBuffer):
+    return vals.finalize()
+
+  return np.array(vals)
+
 class TimeSeries(dict):
-  def __init__(self, metadata=None):
+  """
+    columnar: if False, points are accumulated in lists and converted to arrays in finalize.
+              if True, numeric fields are written into ColumnBuffers that double in size when full.
+              if an int, numeric fields are written into ColumnBuffers with that fixed chunk size.
+              Non-numeric fields (e.g. Rotations, strings) always use lists.
+  """
+  def __init__(self, metadata=None, columnar=False):
     self.times = []
     self.meta_times = []
     self.metadata = metadata
     self.finalized = False
+    self.columnar = columnar
 
   def __len__(self):
     return len(self.times)
@@ -163,17 +612,130 @@ class TimeSeries(dict):
 
       setattr(obj, name, obj[name])
 
+  def _build_template(self, d, parent, template):
+    """ Flattens the field tree into (parent index, name, values) entries, where
+        values is None for nested dicts, which get the next index in build order.
+    """
+    for name, val in d.items():
+      if isinstance(val, dict):
+        template.append((parent, name, None))
+        self._build_template(val, sum(vals is None for _, _, vals in template), template)
+      elif isinstance(val, np.ndarray) or isinstance(val, list) or type(val) is R:
+        template.append((parent, name, val))
+      else:
+        print("Unhandled value:", val, ". Please fix me.")
+        assert False
+
+    return template
+
   def point_iter(self):
     assert self.finalized
+
+    # Walk the field tree once instead of once per point.
+    template = self._build_template(self, 0, [])
+    has_meta = self.meta_times is not None and len(self.meta_times)
+
     for i in range(len(self.times)):
-      obj = BasicAttrDict()
-      self._build_dict(self, obj, i)
+      objs = [BasicAttrDict()]
+      for parent, name, vals in template:
+        if vals is None:
+          val = BasicAttrDict()
+          objs.append(val)
+        else:
+          val = vals[i]
+
+        obj = objs[parent]
+        obj[name] = val
+        setattr(obj, name, val)
+
+      obj = objs[0]
       obj.t = self.times[i]
-      if self.meta_times is not None and len(self.meta_times):
+      if has_meta:
         obj.meta_t = self.meta_times[i]
 
       yield obj
 
+  def block_iter(self, block_size=1024):
+    """ Like point_iter, but yields blocks of up to block_size points,
+        where each field (and t and meta_t) holds the rows of the block.
+    """
+    assert self.finalized
+    for start in range(0, len(self.times), block_size):
+      ind = slice(start, start + block_size)
+      obj = BasicAttrDict()
+      self._build_dict(self, obj, ind)
+      obj.t = self.times[ind]
+      if self.meta_times is not None and len(self.meta_times):
+        obj.meta_t = self.meta_times[ind]
+
+      yield obj
+
+  def field_paths(self):
+    """ Returns the names of all fields, with nested names joined by '.' as in retime. """
+    return ['.'.join(path) for path, _ in self._leaves(self, ())]
+
+  def _leaves(self, d, prefix):
+    ret = []
+    for name, val in d.items():
+      if isinstance(val, dict):
+        ret += self._leaves(val, prefix + (name,))
+      else:
+        ret.append((prefix + (name,), val))
+
+    return ret
+
+  def get_field(self, fieldstr):
+    """ fieldstr is a '.' separated path of field names, e.g. 'pos' or 'att.quat' """
+    obj = self
+    for field in fieldstr.split('.'):
+      obj = getattr(obj, field)
+
+    return obj
+
+  def flat_iter(self, *fieldstrs):
+    """ Fast replacement for point_iter.
+        Yields tuples (t, val1, val2, ...) for the given fields (see get_field),
+        or for all fields in the order of field_paths() if none are given.
+        Fields are looked up once, so the cost per point is just that of zip.
+    """
+    assert self.finalized
+    if fieldstrs:
+      arrays = [self.get_field(fieldstr) for fieldstr in fieldstrs]
+    else:
+      arrays = [vals for _, vals in self._leaves(self, ())]
+
+    return zip(self.times, *arrays)
+
+  def _chunk_size(self):
+    return None if self.columnar is True or self.columnar is False else self.columnar
+
+  def _new_column(self, val):
+    if self.columnar is not False and ColumnBuffer.supports(val):
+      return ColumnBuffer(val, chunk_size=self._chunk_size())
+
+    return []
+
+  def _extend_column(self, col, vals):
+    """ Appends a block of rows to col.
+        Returns the column, which is a new ColumnBuffer if col was empty and vals are numeric.
+    """
+    if type(vals) is R:
+      # Rotation blocks are concatenated in finalize.
+      col.append(vals)
+      return col
+
+    vals = np.asarray(vals)
+    if not isinstance(col, ColumnBuffer) and not col and ColumnBuffer.supports(vals):
+      col = ColumnBuffer(np.empty(vals.shape[1:], dtype=vals.dtype), chunk_size=self._chunk_size())
+
+    if isinstance(col, ColumnBuffer):
+      col.flush()
+      col.write(vals)
+    else:
+      col.extend(vals)
+
+    return col
+
   def sub_add(self, d, **kwargs):
     for name, val in kwargs.items():
       first = name not in d
@@ -185,7 +747,7 @@ class TimeSeries(dict):
 
       else:
         if first:
-          d[name] = []
+          d[name] = self._new_column(val)
 
         d[name].append(val)
 
@@ -195,17 +757,68 @@ class TimeSeries(dict):
   def add_point(self, time, meta_time=None, **kwargs):
     assert not self.finalized
 
+    if not isinstance(self.times, ColumnBuffer) and not self.times:
+      self.times = self._new_column(time)
     self.times.append(time)
 
     if meta_time is not None:
+      if not isinstance(self.meta_times, ColumnBuffer) and not self.meta_times:
+        self.meta_times = self._new_column(meta_time)
       self.meta_times.append(meta_time)
 
     self.sub_add(self, **kwargs)
 
+    if isinstance(self.times, ColumnBuffer) and self.times.full():
+      self.flush()
+
+  def sub_add_points(self, d, n, **kwargs):
+    for name, vals in kwargs.items():
+      first = name not in d
+      if isinstance(vals, dict):
+        if first:
+          d[name] = BasicAttrDict()
+
+        self.sub_add_points(d[name], n, **vals)
+
+      else:
+        assert len(vals) == n, "Field %s has %d values for %d times" % (name, len(vals), n)
+        d[name] = self._extend_column(d.get(name, []), vals)
+
+      setattr(d, name, d[name])
+
+  def add_points(self, times, meta_times=None, **kwargs):
+    """ Adds a block of points at once.
+        times is an array of length N and each field (possibly in nested dicts)
+        is an array (or Rotation) of N rows. Numeric fields are written directly to
+        ColumnBuffers, so this can be called repeatedly with chunks of a log.
+    """
+    assert not self.finalized
+
+    times = np.asarray(times)
+    self.times = self._extend_column(self.times, times)
+
+    if meta_times is not None:
+      self.meta_times = self._extend_column(self.meta_times, meta_times)
+
+    self.sub_add_points(self, len(times), **kwargs)
+
+  def _flush(self, name, vals, d):
+    if isinstance(vals, ColumnBuffer):
+      vals.flush()
+
+  def flush(self):
+    """ Moves values staged in ColumnBuffers into numpy storage (see ColumnBuffer). """
+    self._flush(None, self.times, None)
+    self._flush(None, self.meta_times, None)
+    self.apply_f(self._flush, self)
+
   def _finalize(self, name, vals, d):
+    if isinstance(vals, ColumnBuffer):
+      d[name] = vals.finalize()
+
     # Special case for Rotation objects
-    if vals and type(vals[0]) is R and hasattr(R, 'concatenate'):
-      d[name] = R.concatenate(vals)
+    elif vals and type(vals[0]) is R:
+      d[name] = concatenate_rotations(vals)
     else:
       try:
         test = np.array(vals)
@@ -220,14 +833,16 @@ class TimeSeries(dict):
     setattr(d, name, d[name])
 
   def finalize(self):
-    self.times = np.array(self.times)
-    self.meta_times = np.array(self.meta_times)
+    self.times = column_array(self.times)
+    self.meta_times = column_array(self.meta_times)
     self.apply_f(self._finalize, self)
 
     if len(self.times):
       self.t0 = self.times[0]
       self.finalized = True
 
+    self.times_sorted = bool(np.all(self.times[:-1] <= self.times[1:]))
+
   def apply_f(self, f, d, *args, **kwargs):
     for name, vals in d.items():
       if isinstance(vals, dict):
@@ -277,52 +892,87 @@ class TimeSeries(dict):
       self.t0 = self.times[0]
 
     self.apply_f(self._reorder_inds, self, sort_inds)
+    self.times_sorted = True
 
-  def get_masked_view(self, timemask):
-    assert self.finalized
-
-    ret = TimeSeries(metadata=self.metadata)
+  def _init_view(self, ret, timemask):
+    """ Sets the times and meta data of ret, a view of this TimeSeries. """
     ret.finalized = True
-    ret.times = self.times[timemask].copy()
+    ret.times_sorted = getattr(self, 'times_sorted', False)
+    ret.times = self.times[timemask]
     if hasattr(self, 't0'):
       if len(ret.times):
         ret.t0 = ret.times[0]
       else:
         ret.t0 = self.t0
     if self.meta_times is not None and len(self.meta_times):
-      ret.meta_times = self.meta_times[timemask].copy()
+      ret.meta_times = self.meta_times[timemask]
     else:
       ret.meta_times = self.meta_times
 
-    masked_copy(self, ret, timemask)
+  def get_masked_view(self, timemask, lazy=False):
+    """ timemask is a boolean mask, an index array or a slice.
+        Slices give views that share memory with this TimeSeries.
+        If lazy, returns a TimeSeriesView that only indexes fields when they are accessed.
+    """
+    assert self.finalized
+
+    if lazy:
+      return TimeSeriesView(self, timemask)
+
+    ret = TimeSeries(metadata=self.metadata)
+    self._init_view(ret, timemask)
+    masked_copy(self, ret, timemask, len(self.times))
 
     return ret
 
-  def get_multiview(self, timess):
+  def get_multiview(self, timess, lazy=False):
+    if getattr(self, 'times_sorted', False):
+      # Binary search for the index range of each window.
+      starts = np.searchsorted(self.times, [times[0] for times in timess], side='left')
+      ends = np.searchsorted(self.times, [times[1] for times in timess], side='right')
+      return self.get_masked_view(index_from_ranges(starts, ends), lazy=lazy)
+
     mask = np.zeros(len(self.times), dtype=bool)
     for times in timess:
       mask = np.logical_or(mask, np.logical_and(times[0] <= self.times, self.times <= times[1]))
-    return self.get_masked_view(mask)
+    return self.get_masked_view(mask, lazy=lazy)
+
+  def get_view(self, start_time, end_time, lazy=False):
+    return self.get_multiview([(start_time, end_time)], lazy=lazy)
 
-  def get_view(self, start_time, end_time):
-    return self.get_multiview([(start_time, end_time)])
+  def get_after(self, start_time, lazy=False):
+    return self.get_view(start_time, np.inf, lazy=lazy)
 
-  def get_after(self, start_time):
-    return self.get_view(start_time, np.inf)
+  def get_before(self, end_time, lazy=False):
+    return self.get_view(-np.inf, end_time, lazy=lazy)
 
-  def get_before(self, end_time):
-    return self.get_view(-np.inf, end_time)
+  def get_all(self, lazy=False):
+    return self.get_view(-np.inf, np.inf, lazy=lazy)
 
-  def get_all(self):
-    return self.get_view(-np.inf, np.inf)
+  def get_window(self, start_time, end_time, lazy=False):
+    """ Like get_view, but for the half-open interval [start_time, end_time),
+        so that consecutive windows do not share samples.
+    """
+    if getattr(self, 'times_sorted', False):
+      start, end = np.searchsorted(self.times, (start_time, end_time), side='left')
+      return self.get_masked_view(slice(start, end), lazy=lazy)
+
+    return self.get_masked_view(np.logical_and(start_time <= self.times, self.times < end_time), lazy=lazy)
+
+  def time_range(self):
+    """ Returns the earliest and latest time, or None if there are no times. """
+    if not len(self.times):
+      return None
+
+    if getattr(self, 'times_sorted', False):
+      return self.times[0], self.times[-1]
+
+    return np.min(self.times), np.max(self.times)
 
   def retime(self, fieldstr, newts, fill_value=0.0, **kwargs):
     from scipy.interpolate import interp1d
 
-    fieldlist = fieldstr.split('.')
-    obj = self
-    for field in fieldlist:
-      obj = getattr(obj, field)
+    obj = self.get_field(fieldstr)
 
     return interp1d(self.times, obj, axis=0, bounds_error=False, fill_value=fill_value, **kwargs)(newts)
 
@@ -335,6 +985,7 @@ class TimeSeries(dict):
     ret = TimeSeries(metadata=self.metadata)
     ret.finalized = True
     ret.times = newts
+    ret.times_sorted = bool(np.all(newts[:-1] <= newts[1:]))
 
     if hasattr(self, 't0'):
       if len(ret.times):
@@ -352,3 +1003,45 @@ class TimeSeries(dict):
     timemask = np.logical_and(ts.times >= self.times[0], ts.times <= self.times[-1])
     ret = self.retimeall(ts.times[timemask], **kwargs)
     return ret, ts.get_masked_view(timemask)
+
+class TimeSeriesView(TimeSeries, LazyDict):
+  """
+    Lazy view of a finalized TimeSeries.
+    Holds the parent and an index (boolean mask, index array or slice) and
+    only indexes a field of the parent when that field is accessed.
+    Views are read-only; use materialize() to get a TimeSeries that can be modified.
+  """
+  def __init__(self, parent, index, cache=True):
+    super().__init__(metadata=parent.metadata)
+    parent._init_view(self, index)
+    self._parent = parent
+    self._index = index
+
+    f_index = f_masked(index, len(parent.times))
+
+    def f(data):
+      if isinstance(data, dict):
+        return LazyAttrDict(data, f, cache)
+      return f_index(data)
+
+    self._init_lazy(parent, f, cache)
+
+  def materialize(self):
+    return self._parent.get_masked_view(self._index)
+
+  def __reduce__(self):
+    return _unpickle_view, (self.materialize(),)
+
+  def get_masked_view(self, timemask, lazy=False):
+    # Index the parent directly to avoid chains of views.
+    index = compose_index(len(self._parent.times), self._index, timemask)
+    return self._parent.get_masked_view(index, lazy=lazy)
+
+  def retimeall(self, newts, interponly=True, **kwargs):
+    return self.materialize().retimeall(newts, interponly=interponly, **kwargs)
+
+  def remove_dup_times(self):
+    raise TypeError("TimeSeriesView is read-only, use materialize()")
+
+  def order_times(self):
+    raise TypeError("TimeSeriesView is read-only, use materialize()")
@@ -33,20 +33,36 @@ class WindModel:
       if set to 0, wind beam will not expand
 
       Ideally, this can be made more physically correct by solving some boundary value diff eq.
+
+      Accepts positions of shape (..., 3) and returns velocities of the same shape.
+      Positions behind the fan have zero velocity.
     """
 
-    dist = pos - self.pos
+    dist = np.asarray(pos) - self.pos
     r_para = dist.dot(self.dir)
 
-    if r_para < 0:
-      return 0
+    r_perp = np.linalg.norm(np.cross(dist, self.dir), axis=-1)
+
+    # Clipped so that the exponential cannot overflow behind the fan
+    r_front = np.maximum(r_para, 0)
+    r_eff = self.radius + self.coneslope * r_front
+    r_perp = np.maximum(0, r_perp - r_eff)
 
-    r_perp = np.linalg.norm(np.cross(dist, self.dir))
+    speed = self.vmax * np.exp(-self.decay_lat * r_perp) * np.exp(-self.decay_long * r_front)
+    speed = np.where(r_para < 0, 0.0, speed)
 
-    r_eff = self.radius + self.coneslope * r_para
-    r_perp = max(0, r_perp - r_eff)
+    return speed[..., np.newaxis] * self.dir
 
-    return self.vmax * np.exp(-self.decay_lat * r_perp) * np.exp(-self.decay_long * r_para) * self.dir
+class WindModelSum:
+  """ Superposition of several fans (WindModel or anything with a velocity(pos) method) """
+  def __init__(self, models):
+    self.models = list(models)
+
+  def velocity(self, pos):
+    vel = np.zeros(np.shape(pos))
+    for model in self.models:
+      vel += model.velocity(pos)
+    return vel
 
 if __name__ == "__main__":
   import matplotlib.pyplot as plt
@@ -68,11 +84,7 @@ if __name__ == "__main__":
     np.linspace(-plot_rad, plot_rad, nz)
   )
 
-  output = np.zeros((ny, nx, nz, 3))
-  for i in range(ny):
-    for j in range(nx):
-      for k in range(nz):
-        output[i, j, k] = model.velocity(np.array((x[i, j, k], y[i, j, k], z[i, j, k])))
+  output = model.velocity(np.stack((x, y, z), axis=-1))
 
   fig = plt.figure("Wind Vector Field")
   ax = fig.gca(projection='3d')